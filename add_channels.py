@@ -1,22 +1,61 @@
+from pathlib import Path
 from tinydb import TinyDB, Query
+from storage import AtomicJSONStorage
+import asyncio
+import os
+import storage
 import sys
 
-db = TinyDB("db.json")
-channels = db.table("channels")
-
-next_id = 0
-for ch in channels.all():
-    next_id = max(next_id, ch["id"])
+# Run with the bot stopped: it keeps the tables, and the ids it allocates,
+# in memory. DB_BACKEND is the one the bot runs with.
+DB_BACKEND = os.environ.get(
+    "DB_BACKEND", "journal" if os.environ.get("DB_WRITE_BEHIND") else "tinydb"
+)
 
-next_id += 1
 
-channels.insert(
-    {
-        "id": next_id,
+def channel(channel_id):
+    return {
+        "id": channel_id,
         "name": sys.argv[1],
         "admins": [],
         "token": sys.argv[2],
         "admin_token": sys.argv[3],
     }
-)
+
+
+async def add_to_sqlite():
+    # After the first import the bot never reads db.json again
+    store = storage.open_store("db.json", backend="sqlite")
+    store.load()
+    channel_id = await store.channels.next_id()
+    await store.channels.insert(channel(channel_id))
+    await store.compact()
+    return channel_id
+
+
+def add_to_tinydb():
+    db = TinyDB("db.json", storage=AtomicJSONStorage)
+    channels = db.table("channels")
+    sequences = db.table("sequences")
+
+    # The sequence the bot allocates channel ids from
+    Sequence = Query()
+    sequence = sequences.get(Sequence.name == "channels")
+    if sequence is not None:
+        next_id = sequence["value"] + 1
+    else:
+        next_id = max((ch["id"] for ch in channels.all()), default=0) + 1
+
+    sequences.upsert(
+        {"name": "channels", "value": next_id}, Sequence.name == "channels"
+    )
+    channels.insert(channel(next_id))
+    return next_id
+
+
+# Until the SQLite database exists the bot imports db.json on its first start
+if DB_BACKEND == "sqlite" and Path("db.sqlite3").exists():
+    next_id = asyncio.run(add_to_sqlite())
+else:
+    next_id = add_to_tinydb()
 print("Channel added with id", next_id)
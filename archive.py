@@ -0,0 +1,151 @@
+"""Cold storage for past events.
+
+Events older than ``ARCHIVE_AFTER_DAYS`` are moved, together with their
+registrations and notifications, to gzip-compressed JSON lines files
+partitioned by the month of the event, ``events-YYYY-MM.jsonl.gz`` in
+``ARCHIVE_DIR``.
+Files are only ever appended to, one gzip member per batch. The batch is
+fsynced before the documents leave the hot store, so a crash in between
+can only leave an event in both places; readers keep the last copy.
+"""
+
+from collections import defaultdict
+from datetime import date, datetime
+from pathlib import Path
+import gzip
+import json
+import logging
+import os
+import storage
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = Path(os.environ.get("ARCHIVE_DIR", "archive"))
+# Events are archived once they are this many days in the past
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", 30))
+# Seconds between runs of the retention job
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", 24 * 3600))
+
+
+def month_path(month, directory=ARCHIVE_DIR):
+    return Path(directory) / f"events-{month}.jsonl.gz"
+
+
+def write(records, directory=ARCHIVE_DIR):
+    """Appends ``records`` to their monthly files and fsyncs them."""
+    by_month = defaultdict(list)
+    for record in records:
+        by_month[record["event"]["date"][:7]].append(record)
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    for month, batch in sorted(by_month.items()):
+        path = month_path(month, directory)
+        lines = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch)
+        with open(path, "ab") as f:
+            f.write(gzip.compress(lines.encode("utf-8")))
+            f.flush()
+            os.fsync(f.fileno())
+        storage.fsync_dir(path)
+
+
+def records(start=None, stop=None, directory=ARCHIVE_DIR):
+    """Archived records of events dated in [start, stop), oldest month first.
+
+    ``start`` and ``stop`` are dates; only the files of the months in range
+    are opened.
+    """
+    first = start.isoformat()[:7] if start else ""
+    last = stop.isoformat()[:7] if stop else "9999-99"
+    seen = {}
+    for path in sorted(Path(directory).glob("events-*.jsonl.gz")):
+        month = path.name[len("events-") : -len(".jsonl.gz")]
+        if not first <= month <= last:
+            continue
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                day = record["event"]["date"]
+                if start and day < start.isoformat():
+                    continue
+                if stop and day >= stop.isoformat():
+                    continue
+                # A repeated archive run after a crash wrote the event again
+                seen[record["event"]["id"]] = record
+    return sorted(
+        seen.values(),
+        key=lambda r: (r["event"]["date"], r["event"].get("minutes") or 0),
+    )
+
+
+def attendance(username, start=None, stop=None, directory=ARCHIVE_DIR):
+    """Archived events ``username`` was registered for."""
+    return [
+        record["event"]
+        for record in records(start, stop, directory)
+        if username in record["registrations"]
+    ]
+
+
+def channel_history(channel_id, start=None, stop=None, directory=ARCHIVE_DIR):
+    """``(event, registered usernames)`` of the channel's archived events."""
+    return [
+        (record["event"], record["registrations"])
+        for record in records(start, stop, directory)
+        if record["event"]["channel_id"] == channel_id
+    ]
+
+
+def select(store, channel_id, before):
+    """Ids of the channel's events dated before the ``before`` date."""
+    return [
+        store.events.peek_doc(doc_id, "id")[0]
+        for doc_id in store.events.ordered(channel_id, (), (before.toordinal(),))
+    ]
+
+
+async def move(store, event_ids, directory=ARCHIVE_DIR):
+    """Archives the events and drops them from the store.
+
+    Callers hold the locks of the events. Returns the number archived.
+    """
+    archived = datetime.now().isoformat(timespec="seconds")
+    batch = []
+    for event_id in event_ids:
+        event = store.events.get(event_id)
+        if event is None:
+            continue
+        reg_ids = sorted(store.registrations.doc_ids("event_id", event_id))
+        notification_ids = store.notification.doc_ids("event_id", event_id)
+        batch.append(
+            {
+                "event": dict(event),
+                "registrations": [
+                    store.registrations.peek_doc(doc_id, "username")[0]
+                    for doc_id in reg_ids
+                ],
+                "notifications": [
+                    dict(store.notification.get_doc(doc_id))
+                    for doc_id in sorted(notification_ids)
+                ],
+                "archived": archived,
+            }
+        )
+    if not batch:
+        return 0
+    await storage.run_io(write, batch, directory)
+    event_ids = [record["event"]["id"] for record in batch]
+    for table in (store.registrations, store.notification):
+        await table.remove_doc_ids(
+            {
+                doc_id
+                for event_id in event_ids
+                for doc_id in table.doc_ids("event_id", event_id)
+            }
+        )
+    await store.events.remove_many(event_ids)
+    logger.info("Archived %d events", len(batch))
+    return len(batch)
+
+
+def cutoff(today=None):
+    today = today or date.today()
+    return date.fromordinal(today.toordinal() - ARCHIVE_AFTER_DAYS)
@@ -0,0 +1,43 @@
+"""Compares the old if/elif dispatch on split text to the callbacks table.
+
+Run from the repository root: ``python benchmarks/bench_dispatch.py``.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import callbacks
+
+NAMES = list(callbacks.CODES)
+
+
+def chain(data):
+    parts = data.split(" ")
+    for name in NAMES:
+        if parts[0] == name:
+            return name, parts[1:]
+
+
+def table(data):
+    code, args = callbacks.decode(data)
+    return callbacks.ACTIONS.get(code), args
+
+
+def main(number=200_000):
+    # The last actions are the worst case for the chain
+    for name in ("add-event", "unregister", "add-channel"):
+        legacy = f"{name} 1234"
+        encoded = callbacks.encode(name, 1234)
+        for label, fn, data in (
+            ("if/elif", chain, legacy),
+            ("table", table, encoded),
+        ):
+            seconds = timeit.timeit(lambda: fn(data), number=number)
+            print(f"{name:12} {label:8} {seconds / number * 1e9:8.0f} ns/op")
+
+
+if __name__ == "__main__":
+    main()
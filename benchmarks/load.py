@@ -0,0 +1,345 @@
+"""Replays a synthetic update stream against the bot handlers.
+
+Seeds a fresh database in a temporary directory, then feeds a weighted
+mix of /start, event lists, (un)registrations, admin edits and reminder
+batches through the same per-chat ordered processor the bot uses. The
+Bot API is replaced by ``RecordingBot``, which answers every call
+locally. Reports p50/p95/p99 latency per update kind and throughput.
+
+    python benchmarks/load.py --events 10000 --users 500 --updates 5000
+    python benchmarks/load.py --scenario register --users 500 --backend sqlite
+"""
+
+from datetime import date, timedelta
+from types import SimpleNamespace
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Bot, Update
+
+import callbacks
+import dates
+import updates
+
+# Update kind -> relative weight in the default mix
+MIX = {
+    "start": 15,
+    "events": 25,
+    "register": 20,
+    "unregister": 10,
+    "list-event": 10,
+    "change-event": 10,
+    "event-name": 8,
+    "notify": 2,
+}
+NOTIFY_BATCH = 20
+ADMIN = "admin0"
+
+
+class RecordingBot(Bot):
+    """Answers Bot API calls locally after ``latency`` seconds."""
+
+    def __init__(self, latency=0.0):
+        super().__init__("1:load")
+        with self._unfrozen():
+            self.latency = latency
+            self.calls = collections.Counter()
+
+    async def _do_post(self, endpoint, data, **kwargs):
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+        if endpoint.startswith(("send", "edit")):
+            chat_id = data.get("chat_id", 1)
+            return {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+            }
+        return True
+
+
+def seed(path, channels, events, users, registered):
+    rng = random.Random(0)
+    today = date.today()
+    names = [f"user{i}" for i in range(users)]
+    db = {
+        "channels": {},
+        "events": {},
+        "registrations": {},
+        "notification": {},
+        "settings": {},
+    }
+    for channel_id in range(1, channels + 1):
+        db["channels"][str(channel_id)] = {
+            "id": channel_id,
+            "name": f"channel {channel_id}",
+            "registered_users": names,
+            "admins": [ADMIN],
+            "token": f"token-{channel_id}",
+            "admin_token": f"admin-token-{channel_id}",
+        }
+    notifications = 0
+    for event_id in range(1, events + 1):
+        day = today + timedelta(days=rng.randrange(-30, 90))
+        event_users = rng.sample(names, min(registered, users))
+        db["events"][str(event_id)] = {
+            "id": event_id,
+            "name": f"event {event_id}",
+            **dates.date_fields(day.isoformat()),
+            **dates.time_fields(f"{rng.randrange(8, 22)}:00"),
+            "capacity": 0 if event_id % 5 else registered + 10,
+            "taken": len(event_users),
+            "channel_id": 1 + event_id % channels,
+        }
+        for user in event_users:
+            db["registrations"][str(len(db["registrations"]) + 1)] = {
+                "event_id": event_id,
+                "username": user,
+            }
+        if day > today:
+            for user in event_users:
+                notifications += 1
+                db["notification"][str(notifications)] = {
+                    "event_id": event_id,
+                    "chat_id": chat_id(user),
+                    "date": (day - timedelta(days=1)).isoformat(),
+                }
+    with open(path, "w") as f:
+        json.dump(db, f)
+    return names
+
+
+def chat_id(user):
+    return 1000 + int(user.removeprefix("user")) if user != ADMIN else 999
+
+
+def user_json(user):
+    return {"id": chat_id(user), "is_bot": False, "first_name": user, "username": user}
+
+
+def message_json(update_id, user, text):
+    message = {
+        "message_id": update_id,
+        "date": 0,
+        "chat": {"id": chat_id(user), "type": "private"},
+        "from": user_json(user),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [
+            {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+        ]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_json(update_id, user, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user_json(user),
+            "chat_instance": "load",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": chat_id(user), "type": "private"},
+                "text": "events",
+            },
+        },
+    }
+
+
+class Load:
+    def __init__(self, bot, sched_bot, names, rng):
+        self.bot = bot
+        self.sb = sched_bot
+        self.names = names
+        self.rng = rng
+        self.update_id = 0
+        self.event_ids = [event["id"] for event in sched_bot.events.all()]
+        self.channel_ids = list(sched_bot.channels_obj)
+
+    def update(self, data):
+        return Update.de_json(data, self.bot)
+
+    def next_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    def context(self, args=()):
+        return SimpleNamespace(bot=self.bot, args=list(args), job_queue=None)
+
+    def button(self, user, name, *args):
+        update = self.update(
+            callback_json(self.next_id(), user, callbacks.encode(name, *args))
+        )
+        return update, self.sb.button(update, self.context())
+
+    def make(self, kind, user=None):
+        """Returns ``(update, coroutine)`` for one update of ``kind``."""
+        rng = self.rng
+        user = user or rng.choice(self.names)
+        if kind == "start":
+            update = self.update(message_json(self.next_id(), user, "/start"))
+            return update, self.sb.start_command(update, self.context())
+        if kind == "events":
+            return self.button(user, "events", rng.choice(self.channel_ids))
+        if kind in ("register", "unregister"):
+            return self.button(user, kind, rng.choice(self.event_ids))
+        if kind == "list-event":
+            return self.button(ADMIN, kind, rng.choice(self.channel_ids))
+        if kind == "change-event":
+            return self.button(ADMIN, kind, rng.choice(self.event_ids))
+        if kind == "event-name":
+            # The prompt button followed by the admin's reply
+            event_id = rng.choice(self.event_ids)
+            prompt, prompt_coro = self.button(ADMIN, kind, event_id)
+            reply = self.update(
+                message_json(self.next_id(), ADMIN, f"renamed {event_id}")
+            )
+
+            async def edit():
+                await prompt_coro
+                await self.sb.msg_process(reply, self.context())
+
+            return prompt, edit()
+        if kind == "notify":
+
+            async def notify():
+                due = self.sb.notification.all()[:NOTIFY_BATCH]
+                await self.sb.send_notification(self.context(), due)
+
+            return None, notify()
+        raise ValueError(kind)
+
+
+async def replay(load, stream, concurrency):
+    processor = updates.ChatOrderedUpdateProcessor(concurrency)
+    latencies = collections.defaultdict(list)
+
+    async def timed(kind, coroutine):
+        started = time.perf_counter()
+        await coroutine
+        latencies[kind].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with processor:
+        await asyncio.gather(
+            *(
+                processor.process_update(update, timed(kind, coroutine))
+                for kind, (update, coroutine) in stream
+            )
+        )
+    return latencies, time.perf_counter() - started
+
+
+def mix_stream(load, count):
+    kinds = list(MIX)
+    weights = [MIX[kind] for kind in kinds]
+    for kind in load.rng.choices(kinds, weights, k=count):
+        yield kind, load.make(kind)
+
+
+def register_stream(load, count):
+    # Every user hits "register" on the same event at once
+    event_id = load.event_ids[0]
+    for user in load.names[:count]:
+        yield "register", load.button(user, "register", event_id)
+
+
+def percentile(values, q):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def report(latencies, elapsed, bot):
+    total = sum(len(values) for values in latencies.values())
+    print(f"{'kind':14} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for kind, values in sorted(latencies.items()):
+        row = [percentile(values, q) * 1000 for q in (50, 95, 99)]
+        print(f"{kind:14} {len(values):6d} " + " ".join(f"{v:8.2f}" for v in row))
+    print(f"{total} updates in {elapsed:.2f} s, {total / elapsed:.0f} updates/s")
+    print("Bot API calls:", dict(bot.calls))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=("mix", "register"), default="mix")
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--registered", type=int, default=10)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.0, help="Bot API delay, s")
+    parser.add_argument("--real-limits", action="store_true")
+    parser.add_argument(
+        "--backend", choices=("tinydb", "journal", "sqlite"), default="tinydb"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="keep the seeded db")
+    args = parser.parse_args(argv)
+
+    if not args.real_limits:
+        # Reminder batches would otherwise be paced at 30 messages/s
+        os.environ.setdefault("SEND_GLOBAL_RATE", "1000000")
+        os.environ.setdefault("SEND_CHAT_RATE", "1000000")
+    os.environ["DB_BACKEND"] = args.backend
+    workdir = tempfile.mkdtemp(prefix="sched-bot-load-")
+    os.chdir(workdir)
+    os.mkdir("data")
+    names = seed("db.json", args.channels, args.events, args.users, args.registered)
+
+    # Imported only now: the bot opens db.json from the working directory
+    import sentry_sdk
+
+    sentry_sdk.init = lambda *args, **kwargs: None
+    import sched_bot
+
+    logging.disable(logging.WARNING)
+    sched_bot.store.recover()
+    sched_bot.store.load()
+    sched_bot.media_store.load()
+    for channel in sched_bot.channels.all():
+        sched_bot.channels_obj[channel["id"]] = sched_bot.Channel(
+            channel["id"], channel["name"]
+        )
+
+    bot = RecordingBot(args.latency)
+    load = Load(bot, sched_bot, names, random.Random(args.seed))
+    if args.scenario == "mix":
+        stream = list(mix_stream(load, args.updates))
+    else:
+        stream = list(register_stream(load, args.users))
+    print(
+        f"{args.scenario}: {args.events} events, {args.users} users, "
+        f"concurrency {args.concurrency}"
+    )
+    latencies, elapsed = asyncio.run(replay(load, stream, args.concurrency))
+    report(latencies, elapsed, bot)
+    if args.keep:
+        print("Database kept in", workdir)
+    else:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Compact callback_data encoding and the button action registry.
+
+Callback data is ``VERSION`` followed by URL-safe base64 (no padding) of
+an action code byte and its arguments, each tagged: ``0`` + varint for
+ints, ``1`` + length byte + UTF-8 for strings. Codes are stable, only ever
+append to ``CODES``. Data without the version prefix is the legacy
+``"<action> <args...>"`` text still present on already sent keyboards.
+"""
+
+import base64
+import logging
+
+logger = logging.getLogger(__name__)
+
+VERSION = "1"
+# Telegram limit for callback_data, in bytes
+MAX_LENGTH = 64
+
+CODES = {
+    "add-event": 1,
+    "events": 2,
+    "admin": 3,
+    "list-event": 4,
+    "change-event": 5,
+    "event-name": 6,
+    "event-date": 7,
+    "event-time": 8,
+    "event-capacity": 9,
+    "event-message": 10,
+    "event-hidden": 11,
+    "event-delete": 12,
+    "event-add": 13,
+    "event-remove": 14,
+    "event-remove-user": 15,
+    "register": 16,
+    "unregister": 17,
+    "add-message": 18,
+    "del-message": 19,
+    "add-emessage": 20,
+    "del-emessage": 21,
+    "settings": 22,
+    "add-channel": 23,
+    "delete-old": 24,
+    "series": 25,
+    "add-series": 26,
+    "del-series": 27,
+}
+ACTIONS = {code: name for name, code in CODES.items()}
+
+# Legacy "change-event <id> <field> [<user>]" sub-commands
+LEGACY_EVENT_ACTIONS = {
+    "name": "event-name",
+    "date": "event-date",
+    "time": "event-time",
+    "capacity": "event-capacity",
+    "message": "event-message",
+    "hidden": "event-hidden",
+    "delete": "event-delete",
+    "add": "event-add",
+    "remove": "event-remove",
+    "remove-user": "event-remove-user",
+}
+
+handlers = {}
+
+
+def handler(name):
+    """Registers the decorated coroutine as the handler of action ``name``."""
+
+    def register(fn):
+        handlers[CODES[name]] = fn
+        return fn
+
+    return register
+
+
+def _varint(value, out):
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode(name, *args):
+    out = bytearray([CODES[name]])
+    for arg in args:
+        if isinstance(arg, int):
+            out.append(0)
+            _varint(arg, out)
+        else:
+            raw = str(arg).encode("utf-8")
+            out.append(1)
+            out.append(len(raw))
+            out += raw
+    data = VERSION + base64.urlsafe_b64encode(out).rstrip(b"=").decode("ascii")
+    if len(data) > MAX_LENGTH:
+        raise ValueError(f"Callback data for {name!r} is too long: {len(data)}")
+    return data
+
+
+def _decode_binary(payload):
+    raw = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+    code, pos, args = raw[0], 1, []
+    while pos < len(raw):
+        tag = raw[pos]
+        pos += 1
+        if tag == 0:
+            value, shift = 0, 0
+            while True:
+                byte = raw[pos]
+                pos += 1
+                value |= (byte & 0x7F) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            args.append(value)
+        else:
+            length = raw[pos]
+            args.append(raw[pos + 1 : pos + 1 + length].decode("utf-8"))
+            pos += 1 + length
+    return code, args
+
+
+def _decode_legacy(data):
+    parts = data.split(" ")
+    name, args = parts[0], parts[1:]
+    if name == "change-event" and len(args) > 1:
+        name = LEGACY_EVENT_ACTIONS.get(args[1], args[1])
+        args = args[:1] + args[2:]
+    return CODES.get(name), [int(arg) if arg.isdigit() else arg for arg in args]
+
+
+def decode(data):
+    """Returns ``(code, args)``; ``code`` is None for unknown actions."""
+    try:
+        if data.startswith(VERSION):
+            return _decode_binary(data[len(VERSION) :])
+        return _decode_legacy(data)
+    except (ValueError, IndexError) as e:
+        logger.error("Bad callback data %r: %r", data, e)
+        return None, []
+
+
+def resolve(data):
+    """Returns ``(name, handler, args)`` for callback ``data``."""
+    code, args = decode(data)
+    return ACTIONS.get(code), handlers.get(code), args
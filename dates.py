@@ -0,0 +1,38 @@
+from datetime import date, datetime
+
+
+def parse_date(text):
+    text = text.strip()
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"Неверная дата {text!r}, ожидается формат 2024-09-30")
+
+
+def parse_time(text):
+    text = text.strip()
+    for fmt in ("%H:%M", "%H.%M"):
+        try:
+            parsed = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        return parsed.hour * 60 + parsed.minute
+    raise ValueError(f"Неверное время {text!r}, ожидается формат 12:00")
+
+
+def date_fields(text):
+    day = parse_date(text)
+    return {"date": day.isoformat(), "day": day.toordinal()}
+
+
+def time_fields(text):
+    minutes = parse_time(text)
+    return {"time": f"{minutes // 60:02d}:{minutes % 60:02d}", "minutes": minutes}
+
+
+def label(event):
+    if not event.get("day"):
+        return event["date"]
+    return date.fromordinal(event["day"]).strftime("%a %d.%b")
@@ -0,0 +1,94 @@
+from telegram.error import RetryAfter
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+SEND_CONCURRENCY = int(os.environ.get("SEND_CONCURRENCY", 8))
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", 30))
+CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", 1))
+CHAT_BURST = 2
+MAX_RETRIES = 3
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Dispatcher:
+    """Fans out bot calls over a bounded pool within Telegram's rate limits.
+
+    Every call takes a token from the global bucket and from its chat's
+    bucket; ``RetryAfter`` is honoured up to ``MAX_RETRIES`` times.
+    """
+
+    def __init__(
+        self,
+        bot,
+        concurrency=SEND_CONCURRENCY,
+        global_rate=GLOBAL_RATE,
+        chat_rate=CHAT_RATE,
+        global_burst=None,
+        chat_burst=CHAT_BURST,
+    ):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+        self._slots = asyncio.Semaphore(concurrency)
+
+    async def call(self, method, chat_id, **kwargs):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        for attempt in range(MAX_RETRIES + 1):
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                return await getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                retry_after = e.retry_after
+                if not isinstance(retry_after, (int, float)):
+                    retry_after = retry_after.total_seconds()
+                logger.warning("Rate limited for %s s on chat %s", retry_after, chat_id)
+                await asyncio.sleep(retry_after)
+
+    async def run(self, jobs):
+        """Runs ``job(self)`` coroutines concurrently, returns their results.
+
+        A job that raises is logged and reported as ``None``.
+        """
+
+        async def guarded(job):
+            async with self._slots:
+                try:
+                    return await job(self)
+                except Exception as e:
+                    logger.error(e, exc_info=True)
+                    return None
+
+        return await asyncio.gather(*(guarded(job) for job in jobs))
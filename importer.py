@@ -0,0 +1,138 @@
+"""Parsing of event lists for the bulk "add-event" import.
+
+Each parser returns ``(events, errors)``: the fields of every valid event
+in input order and ``(line, message)`` pairs for the rest, so one reply
+can list all problems before anything is written.
+"""
+
+from datetime import datetime, timezone
+import csv
+import dates
+import io
+import re
+
+# Largest uploaded file read by the bot, in bytes
+MAX_FILE_SIZE = 1024 * 1024
+CSV_HEADERS = {"name", "название"}
+
+
+def parse_capacity(text):
+    """Number of places, 0 (or empty) for unlimited."""
+    text = str(text).strip()
+    if text and not text.isdigit():
+        raise ValueError(f"Неверное количество мест {text!r}, ожидается число")
+    return int(text or 0)
+
+
+def event_fields(name, day, time, capacity):
+    name = name.strip()
+    if not name:
+        raise ValueError("Пустое название")
+    return {
+        "name": name,
+        **dates.date_fields(day),
+        **dates.time_fields(time),
+        "capacity": parse_capacity(capacity),
+    }
+
+
+def _collect(rows):
+    events, errors = [], []
+    for line, fields in rows:
+        try:
+            if len(fields) != 4:
+                raise ValueError("Ожидается формат Название@дата@время@количество мест")
+            events.append(event_fields(*fields))
+        except ValueError as e:
+            errors.append((line, str(e)))
+    return events, errors
+
+
+def parse_text(text):
+    """Parses ``name@date@time@capacity`` lines, blank lines are skipped."""
+    return _collect(
+        (line, row.split("@"))
+        for line, row in enumerate(text.splitlines(), 1)
+        if row.strip()
+    )
+
+
+def parse_csv(text):
+    """Parses ``name,date,time,capacity`` rows with an optional header."""
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(io.StringIO(text), dialect)
+    rows = []
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        if reader.line_num == 1 and row[0].strip().lower() in CSV_HEADERS:
+            continue
+        rows.append((reader.line_num, row[:4]))
+    return _collect(rows)
+
+
+def _ics_start(value):
+    if len(value) < 15:
+        raise ValueError("Не указано время начала")
+    start = datetime.strptime(value[:15], "%Y%m%dT%H%M%S")
+    if value.endswith("Z"):
+        # UTC times are shown in the server's local time, like all events
+        start = start.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    return start
+
+
+def parse_ics(text):
+    """Parses the VEVENTs of an iCalendar file.
+
+    SUMMARY is the name, DTSTART the date and time, the non-standard
+    X-CAPACITY property the number of places (unlimited when missing).
+    Recurrence rules are not expanded.
+    """
+    # Long lines are folded onto continuation lines starting with a space
+    lines = re.sub(r"\r?\n[ \t]", "", text).splitlines()
+    rows, current = [], None
+    for line, content in enumerate(lines, 1):
+        if content == "BEGIN:VEVENT":
+            current, start_line = {}, line
+        elif content == "END:VEVENT" and current is not None:
+            rows.append((start_line, current))
+            current = None
+        elif current is not None and ":" in content:
+            key, _, value = content.partition(":")
+            current[key.split(";")[0].upper()] = value.strip()
+    events, errors = [], []
+    for line, props in rows:
+        try:
+            start = _ics_start(props.get("DTSTART", ""))
+            events.append(
+                event_fields(
+                    props.get("SUMMARY", "").replace("\\,", ","),
+                    start.date().isoformat(),
+                    start.strftime("%H:%M"),
+                    props.get("X-CAPACITY", 0),
+                )
+            )
+        except ValueError as e:
+            errors.append((line, str(e)))
+    return events, errors
+
+
+def parse_file(name, raw):
+    """Parses an uploaded ``.csv``, ``.ics`` or plain text file."""
+    text = raw.decode("utf-8-sig")
+    name = (name or "").lower()
+    if name.endswith(".ics"):
+        return parse_ics(text)
+    if name.endswith(".csv"):
+        return parse_csv(text)
+    return parse_text(text)
+
+
+def error_report(errors, limit=30):
+    lines = [f"Строка {line}: {message}" for line, message in errors[:limit]]
+    if len(errors) > limit:
+        lines.append(f"... и ещё {len(errors) - limit}")
+    return "\n".join(lines)
@@ -0,0 +1,72 @@
+from collections import Counter
+from contextlib import asynccontextmanager
+import asyncio
+import metrics
+import time
+
+
+def channel(channel_id):
+    return ("channel", int(channel_id))
+
+
+def event(event_id):
+    return ("event", int(event_id))
+
+
+def notification(event_id):
+    return ("notification", int(event_id))
+
+
+def setting(name):
+    return ("setting", name)
+
+
+def table(name):
+    return ("table", name)
+
+
+def chat(chat_id):
+    return ("chat", int(chat_id))
+
+
+class LockManager:
+    """Per-key asyncio locks.
+
+    ``hold`` takes every requested key in sorted order (channel, event,
+    notification, setting, table), so two operations touching the same
+    keys can never deadlock. Locks are dropped once nobody holds or waits for them.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._users = Counter()
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        keys = sorted(set(keys))
+        for key in keys:
+            self._locks.setdefault(key, asyncio.Lock())
+            self._users[key] += 1
+        acquired = []
+        started = time.perf_counter()
+        try:
+            for key in keys:
+                await self._locks[key].acquire()
+                acquired.append(key)
+            metrics.observe(
+                "lock_wait_seconds",
+                time.perf_counter() - started,
+                keys=",".join(key[0] for key in keys),
+            )
+            yield
+        finally:
+            for key in reversed(acquired):
+                self._locks[key].release()
+            for key in keys:
+                self._users[key] -= 1
+                if not self._users[key]:
+                    del self._users[key]
+                    del self._locks[key]
+
+    def locked(self, key):
+        return key in self._locks and self._locks[key].locked()
@@ -0,0 +1,119 @@
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# Per-module overrides, e.g. "storage=WARNING,telegram=INFO"
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "httpx=WARNING,telegram=WARNING")
+# "json" for one JSON object per line, "text" for the old human format
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_FILE = os.environ.get("LOG_FILE")
+# Share of high-volume records (logged with extra=HOT) that is kept
+LOG_HOT_SAMPLE = float(os.environ.get("LOG_HOT_SAMPLE", 0.1))
+
+HOT = {"hot": True}
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Attributes every LogRecord has; anything else came in through ``extra``
+RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_FIELDS and key != "hot":
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class HotSampler(logging.Filter):
+    """Keeps ``rate`` of the INFO and lower records marked with ``HOT``."""
+
+    def __init__(self, rate=LOG_HOT_SAMPLE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if not getattr(record, "hot", False) or record.levelno > logging.INFO:
+            return True
+        return random.random() < self.rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting them.
+
+    The stock ``prepare`` renders the message on the calling thread, i.e.
+    on the event loop; here arguments are only formatted by the listener.
+    Callers must therefore only pass arguments that are not mutated later.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def parse_levels(spec):
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup(
+    level=LOG_LEVEL,
+    levels=LOG_LEVELS,
+    format=LOG_FORMAT,
+    path=LOG_FILE,
+    hot_sample=LOG_HOT_SAMPLE,
+):
+    """Routes every log record through a queue to a background writer.
+
+    Returns the started ``QueueListener``; ``shutdown`` runs at exit.
+    """
+    if format == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
+    target = logging.FileHandler(path) if path else logging.StreamHandler(sys.stderr)
+    target.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    handler = LazyQueueHandler(records)
+    handler.addFilter(HotSampler(hot_sample))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, module_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    global _listener
+    shutdown()
+    _listener = QueueListener(records, target, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown():
+    """Writes out queued records and stops the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+_listener = None
+atexit.register(shutdown)
@@ -0,0 +1,261 @@
+from collections import OrderedDict
+from pathlib import Path
+import json
+import logging
+import os
+import threading
+import storage
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+MEDIA_PATH = "data/media.jsonl"
+MEDIA_CACHE_SIZE = int(os.environ.get("MEDIA_CACHE_SIZE", 256))
+
+
+def as_record(data):
+    """Converts a legacy ``data/<uuid>.pkl`` payload into a media record.
+
+    Those files keep a pickled ``PhotoSize`` (base image) or a
+    ``{"photo": PhotoSize | None, "msg": str}`` dict.
+    """
+    if isinstance(data, dict):
+        photo = data.get("photo")
+        return {
+            "file_id": photo.file_id if photo is not None else None,
+            "caption": data.get("msg"),
+        }
+    return {"file_id": data.file_id, "caption": None}
+
+
+class MediaStore:
+    """Append-only JSON lines file of media records.
+
+    Every record is ``{uuid, kind, file_id, caption}``; deletions append a
+    ``{uuid, deleted}`` tombstone. ``load`` builds an in-memory index of
+    byte offsets so a read is one seek, and ``compact`` rewrites the file
+    keeping only records that are still referenced.
+    """
+
+    def __init__(self, path=MEDIA_PATH):
+        self.path = Path(path)
+        self._offsets = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, uuid):
+        return uuid in self._offsets
+
+    def load(self):
+        self._offsets.clear()
+        if not self.path.exists():
+            return
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("Media store truncated at byte %d", offset)
+                    break
+                if record.get("deleted"):
+                    self._offsets.pop(record["uuid"], None)
+                else:
+                    self._offsets[record["uuid"]] = (offset, len(line))
+                offset += len(line)
+        if offset != self.path.stat().st_size:
+            # Drop the torn tail so the next append starts on a fresh line
+            os.truncate(self.path, offset)
+        logger.info("Loaded %d media records", len(self._offsets))
+
+    def read(self, uuid):
+        with self._lock:
+            position = self._offsets.get(uuid)
+            if position is None:
+                return None
+            offset, length = position
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                record = json.loads(f.read(length))
+        return {"file_id": record["file_id"], "caption": record["caption"]}
+
+    def _append(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        return offset, len(line)
+
+    def records(self):
+        """Yields every live record, ``uuid`` and ``kind`` included."""
+        with self._lock, open(self.path, "rb") as f:
+            for offset, length in self._offsets.values():
+                f.seek(offset)
+                yield json.loads(f.read(length))
+
+    def write(self, uuid, kind, file_id, caption):
+        record = {"uuid": uuid, "kind": kind, "file_id": file_id, "caption": caption}
+        with self._lock:
+            self._offsets[uuid] = self._append(record)
+
+    def delete(self, uuid):
+        with self._lock:
+            if self._offsets.pop(uuid, None) is not None:
+                self._append({"uuid": uuid, "deleted": True})
+
+    def compact(self, live):
+        with self._lock:
+            if not self.path.exists():
+                return
+            kept = sum(
+                length for uuid, (_, length) in self._offsets.items() if uuid in live
+            )
+            if kept == self.path.stat().st_size:
+                return
+            tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+            offsets = {}
+            offset = 0
+            with open(self.path, "rb") as src, open(tmp_path, "wb") as dst:
+                for uuid, (position, length) in self._offsets.items():
+                    if uuid not in live:
+                        continue
+                    src.seek(position)
+                    dst.write(src.read(length))
+                    offsets[uuid] = (offset, length)
+                    offset += length
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp_path, self.path)
+            storage.fsync_dir(self.path)
+            logger.info(
+                "Compacted media store: %d live, %d orphans dropped",
+                len(offsets),
+                len(self._offsets) - len(offsets),
+            )
+            self._offsets = offsets
+
+
+class SQLiteMediaStore:
+    """Media records in the ``media`` table of the SQLite database.
+
+    Same interface as ``MediaStore``; on first ``load`` the records of the
+    JSON lines store at ``import_path`` are copied over.
+    """
+
+    def __init__(self, path, import_path=MEDIA_PATH):
+        self.conn = storage.sqlite_connect(path)
+        self.import_path = Path(import_path)
+        self._uuids = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._uuids)
+
+    def __contains__(self, uuid):
+        return uuid in self._uuids
+
+    def load(self):
+        with self._lock:
+            (count,) = self.conn.execute("SELECT count(*) FROM media").fetchone()
+            if not count and self.import_path.exists():
+                legacy = MediaStore(self.import_path)
+                legacy.load()
+                with storage.transaction(self.conn):
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)",
+                        [
+                            (r["uuid"], r["kind"], r["file_id"], r["caption"])
+                            for r in legacy.records()
+                        ],
+                    )
+                logger.info("Imported %d media records", len(legacy))
+            self._uuids = {
+                uuid for (uuid,) in self.conn.execute("SELECT uuid FROM media")
+            }
+        logger.info("Loaded %d media records", len(self._uuids))
+
+    def read(self, uuid):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT file_id, caption FROM media WHERE uuid = ?", (uuid,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"file_id": row[0], "caption": row[1]}
+
+    def write(self, uuid, kind, file_id, caption):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)",
+                (uuid, kind, file_id, caption),
+            )
+            self._uuids.add(uuid)
+
+    def delete(self, uuid):
+        with self._lock:
+            self.conn.execute("DELETE FROM media WHERE uuid = ?", (uuid,))
+            self._uuids.discard(uuid)
+
+    def compact(self, live):
+        with self._lock:
+            orphans = self._uuids - set(live)
+            if not orphans:
+                return
+            with storage.transaction(self.conn):
+                self.conn.executemany(
+                    "DELETE FROM media WHERE uuid = ?", [(uuid,) for uuid in orphans]
+                )
+            self._uuids -= orphans
+            logger.info("Dropped %d orphan media records", len(orphans))
+
+
+class MediaRegistry:
+    """LRU cache of media records keyed by message uuid.
+
+    Only the Telegram ``file_id`` and the caption are kept, so a cache hit
+    costs no disk read.
+    """
+
+    def __init__(self, store, size=MEDIA_CACHE_SIZE):
+        self.store = store
+        self.size = size
+        self._cache = OrderedDict()
+
+    async def get(self, msg_id):
+        if not msg_id:
+            return None
+        if msg_id in self._cache:
+            self._cache.move_to_end(msg_id)
+            return self._cache[msg_id]
+        record = await storage.run_io(self.store.read, msg_id)
+        if record is None:
+            logger.warning("Media record %s not found", msg_id)
+            return None
+        self._remember(msg_id, record)
+        return record
+
+    async def save(self, kind, file_id, caption):
+        uuid = f"{uuid4()}"
+        await storage.run_io(self.store.write, uuid, kind, file_id, caption)
+        self._remember(uuid, {"file_id": file_id, "caption": caption})
+        return uuid
+
+    async def delete(self, msg_id):
+        if not msg_id:
+            return
+        self.invalidate(msg_id)
+        await storage.run_io(self.store.delete, msg_id)
+
+    def invalidate(self, msg_id):
+        self._cache.pop(msg_id, None)
+
+    def _remember(self, msg_id, record):
+        self._cache[msg_id] = record
+        self._cache.move_to_end(msg_id)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
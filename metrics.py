@@ -0,0 +1,158 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Serve /metrics in Prometheus text format on this port, off when unset
+METRICS_PORT = os.environ.get("METRICS_PORT")
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+# Upper bounds in seconds, the last bucket is +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile ``q``."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Registry:
+    """Counters and latency histograms keyed by name and label pairs."""
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+
+    def inc(self, name, value=1, **labels):
+        self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, seconds, **labels):
+        self.histograms[name, tuple(sorted(labels.items()))].observe(seconds)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f"{name}_errors_total", **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def instrument(self, name, **labels):
+        """Times every call of the decorated coroutine function."""
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with self.timed(name, **labels):
+                    return await fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+    def render(self):
+        """Returns every series in the Prometheus text exposition format."""
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), hist in sorted(self.histograms.items()):
+            seen = 0
+            for bound, count in zip((*hist.buckets, "+Inf"), hist.counts):
+                seen += count
+                le = (("le", bound),)
+                lines.append(f"{name}_bucket{_labels(labels + le)} {seen}")
+            lines.append(f"{name}_sum{_labels(labels)} {hist.sum:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top=15):
+        """Short text report of the slowest series by total time."""
+        rows = sorted(
+            self.histograms.items(), key=lambda item: item[1].sum, reverse=True
+        )
+        lines = []
+        for (name, labels), hist in rows[:top]:
+            label = ",".join(str(value) for _, value in labels)
+            lines.append(
+                f"{name}[{label}] n={hist.count} "
+                f"avg={hist.sum / hist.count * 1000:.1f}ms "
+                f"p95<={hist.quantile(0.95) * 1000:g}ms"
+            )
+        errors = sum(
+            value
+            for (name, _), value in self.counters.items()
+            if name.endswith("_errors_total")
+        )
+        lines.append(f"errors={errors}")
+        return "\n".join(lines)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timed = registry.timed
+instrument = registry.instrument
+
+
+async def _serve(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        if request.split(b" ")[1:2] == [b"/metrics"]:
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b""
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serves ``GET /metrics`` on ``host:port``; returns the server."""
+    server = await asyncio.start_server(_serve, host, int(port))
+    logger.info("Metrics on http://%s:%s/metrics", host, port)
+    return server
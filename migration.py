@@ -1,14 +1,16 @@
+from pathlib import Path
 from tinydb import TinyDB, Query
+from tinydb.middlewares import CachingMiddleware
+import dates
 import logging
+import pickle
+import media
+import storage
 logger = logging.getLogger(__name__)
 
 
-db = TinyDB("db.json")
-events = db.table("events")
-channels = db.table("channels")
-migrations = db.table("migrations")
-
-def users_as_names():
+def users_as_names(db):
+    events = db.table("events")
     for event in events.all():
         event["registered_users"] = [
             user for user in event["registered_users"]
@@ -16,24 +18,82 @@ def users_as_names():
         ]
         events.update(event, doc_ids=[event.doc_id])
 
-def int_event_id():
+def int_event_id(db):
+    events = db.table("events")
     i = 1
     for event in events.all():
         event["id"] = i
         events.update(event, doc_ids=[event.doc_id])
         i += 1
 
+def pickle_media(db):
+    # Only referenced files are moved, the rest were never cleaned up
+    kinds = {}
+    for channel in db.table("channels").all():
+        kinds[channel.get("welcome_message")] = "welcome"
+        kinds[channel.get("event_list_message")] = "event-list"
+    for event in db.table("events").all():
+        kinds[event.get("welcome_message")] = "event"
+    for setting in db.table("settings").search(Query().name == "base_image"):
+        kinds[setting.get("value")] = "base-image"
+    store = media.MediaStore()
+    store.load()
+    for path in sorted(Path("data").glob("*.pkl")):
+        uuid = path.stem
+        if uuid in kinds and uuid not in store:
+            try:
+                with open(path, "rb") as f:
+                    record = media.as_record(pickle.load(f))
+            except Exception as e:
+                logger.error("Skip media %s: %r", path, e)
+                continue
+            store.write(uuid, kinds[uuid], record["file_id"], record["caption"])
+        path.unlink()
+
+def event_date_ordinals(db):
+    events = db.table("events")
+    for event in events.all():
+        for fields, value in (
+            (dates.date_fields, event["date"]),
+            (dates.time_fields, event["time"]),
+        ):
+            try:
+                event.update(fields(value))
+            except ValueError as e:
+                logger.error("Event %s: %s", event["id"], e)
+        events.update(event, doc_ids=[event.doc_id])
+
+def registrations_table(db):
+    rows = []
+
+    def move(event):
+        users = list(dict.fromkeys(event.pop("registered_users", [])))
+        rows.extend({"event_id": event["id"], "username": user} for user in users)
+        event["taken"] = len(users)
+
+    db.table("events").update(move)
+    db.table("registrations").insert_multiple(rows)
+
 migrations_to_apply = [
     {"name": "users_as_names", "callback": users_as_names},
     {"name": "int_event_id", "callback": int_event_id},
+    {"name": "pickle_media", "callback": pickle_media},
+    {"name": "event_date_ordinals", "callback": event_date_ordinals},
+    {"name": "registrations_table", "callback": registrations_table},
 ]
 
-def apply():
+def apply(path="db.json"):
+    # Opened here rather than at import: in write-behind mode db.json is
+    # replaced by a fresh snapshot before migrations run. Writes are cached
+    # and written out once on close instead of rewriting the file per update
+    db = TinyDB(path, storage=CachingMiddleware(storage.AtomicJSONStorage))
+    migrations = db.table("migrations")
     logger.info("Starting migrations...")
     for migration in migrations_to_apply:
         if migrations.contains(Query().name == migration["name"]):
             continue
-        migration["callback"]()
+        migration["callback"](db)
         migrations.insert({"name": migration["name"]})
         logger.info("Migration applied: %s", migration["name"])
     logger.info("Migrations completed.")
+    db.close()
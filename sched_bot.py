@@ -1,9 +1,5 @@
-import asyncio
 import os
-import pickle
 import sentry_sdk
-from pathlib import Path
-from tinydb import TinyDB, Query
 from uuid import uuid4
 from html import escape
 from telegram import (
@@ -24,149 +20,269 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-from datetime import datetime, timedelta
+from datetime import date
+import bisect
+import functools
 import logging
+import archive
+import callbacks
+import dates
+import dispatcher
+import importer
+import locks
+import logs
+import media
+import metrics
 import migration
+import scheduler
+import series
+import storage
+import updates
 
 SUPER_ADMINS = ["zztalker"]
 
-# Initialize logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 sentry_sdk.init(
-    dsn="https://02ae47787c57ba6fe2a02cf8b213525b@o314947.ingest.us.sentry.io/4508109744177152",
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for tracing.
-    traces_sample_rate=1.0,
-    # Set profiles_sample_rate to 1.0 to profile 100%
-    # of sampled transactions.
-    # We recommend adjusting this value in production.
-    profiles_sample_rate=1.0,
+    dsn=os.environ.get(
+        "SENTRY_DSN",
+        "https://02ae47787c57ba6fe2a02cf8b213525b@o314947.ingest.us.sentry.io/4508109744177152",
+    ),
+    # Latency is tracked by the metrics module, Sentry only samples traces
+    traces_sample_rate=float(os.environ.get("SENTRY_TRACES_SAMPLE_RATE", 0.01)),
+    # Share of sampled transactions that are also profiled
+    profiles_sample_rate=float(os.environ.get("SENTRY_PROFILES_SAMPLE_RATE", 0)),
 )
 
-db = TinyDB("db.json")
-db_lock = asyncio.Lock()
-events = db.table("events")
-channels = db.table("channels")
-notification = db.table("notification")
-settings = db.table("settings")
+# "tinydb" (write-through db.json), "journal" (write-behind) or "sqlite"
+DB_BACKEND = os.environ.get(
+    "DB_BACKEND", "journal" if os.environ.get("DB_WRITE_BEHIND") else "tinydb"
+)
+DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", 1))
+DB_COMPACT_INTERVAL = float(os.environ.get("DB_COMPACT_INTERVAL", 3600))
+# Rows per page of the event and participant keyboards
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 10))
+# Directions of a page cursor
+NEXT, PREV = 0, 1
+# Action that lists the events for each event button action
+LIST_ACTIONS = {"register": "events", "change-event": "list-event"}
+
+# "polling" or "webhook"; the webhook is served by run_webhook behind WEBHOOK_URL
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+
+db_locks = locks.LockManager()
+store = storage.open_store("db.json", backend=DB_BACKEND)
+events = store.events
+channels = store.channels
+notification = store.notification
+settings = store.settings
+registrations = store.registrations
+if DB_BACKEND == "sqlite":
+    media_store = media.SQLiteMediaStore(store.backend.path)
+else:
+    media_store = media.MediaStore()
+media_registry = media.MediaRegistry(media_store)
 
 channels_obj = {}
 wait_for_message = {}
 
 
-def get_next_id(table):
-    return table.all()[-1]["id"] + 1 if table.all() else 1
+def registered_users(event_id):
+    """Usernames registered for the event, in registration order."""
+    return [
+        registrations.peek_doc(doc_id, "username")[0]
+        for doc_id in sorted(registrations.doc_ids("event_id", event_id))
+    ]
+
+
+async def add_registration(event_id, user):
+    """Registers ``user`` and bumps the event's ``taken`` counter.
+
+    Returns False if the user was already registered. The caller holds
+    the event lock.
+    """
+    if registrations.has((event_id, user)):
+        return False
+    await registrations.insert({"event_id": event_id, "username": user})
+    (taken,) = events.peek(event_id, "taken")
+    await events.update(event_id, {"taken": (taken or 0) + 1})
+    return True
+
+
+async def remove_registration(event_id, user):
+    """Counterpart of ``add_registration``; False if there was none."""
+    if not registrations.has((event_id, user)):
+        return False
+    await registrations.remove((event_id, user))
+    (taken,) = events.peek(event_id, "taken")
+    await events.update(event_id, {"taken": max((taken or 0) - 1, 0)})
+    return True
+
+
+def after(key):
+    """The smallest sort key greater than ``key``, whose last item is a doc id."""
+    return (*key[:-1], key[-1] + 1)
+
+
+def page_buttons(action, args, first, last):
+    """Row of ⬅️/➡️ buttons for the pages before ``first`` and after ``last``.
+
+    ``action`` is called with ``args`` and the cursor; a key of None means
+    there is no page on that side.
+    """
+    buttons = []
+    if first is not None:
+        buttons.append(
+            InlineKeyboardButton(
+                "⬅️", callback_data=callbacks.encode(action, *args, PREV, *first)
+            )
+        )
+    if last is not None:
+        buttons.append(
+            InlineKeyboardButton(
+                "➡️", callback_data=callbacks.encode(action, *args, NEXT, *last)
+            )
+        )
+    return buttons
 
 
 class Channel:
     def __init__(self, id, name):
         self.id = id
         self.name = name
+        self._events_cache = {}
 
     def __str__(self) -> str:
         return f"Channel(id={self.id}, name={self.name})"
 
-    async def all_events(self, cmd=None, full=False, username=None):
-        event_list = events.search(Query().channel_id == self.id)
-        logger.info("Events %r", event_list)
+    def _page(self, full, cursor):
+        """Doc ids of one page of events and whether there are more.
+
+        ``cursor`` is empty for the first page, else ``(direction, *key)``:
+        the page after (``NEXT``) or before (``PREV``) the sort key ``key``.
+        """
+        floor = () if full else (date.today().toordinal(),)
+        if cursor and cursor[0] == PREV:
+            doc_ids = events.ordered(
+                self.id, floor, cursor[1:], limit=PAGE_SIZE, reverse=True
+            )
+        else:
+            start = max(floor, after(cursor[1:])) if cursor else floor
+            doc_ids = events.ordered(self.id, start, limit=PAGE_SIZE)
+        if not doc_ids:
+            return doc_ids, None, None
+        first = events.sort_key(doc_ids[0])
+        last = events.sort_key(doc_ids[-1])
+        has_prev = events.ordered(self.id, floor, first, limit=1, reverse=True)
+        has_next = events.ordered(self.id, after(last), limit=1)
+        return doc_ids, first if has_prev else None, last if has_next else None
+
+    def _event_rows(self, cmd, full, cursor=()):
+        """Keyboard rows for one page of the channel's events.
+
+        The first page is cached until an event in the channel changes or
+        the day rolls over.
+        """
+        today = date.today()
+        version = events.version("channel_id", self.id)
+        cached = self._events_cache.get((cmd, full))
+        if not cursor and cached is not None and cached[0] == (version, today):
+            return cached[1:]
         keyboard = []
-        for event in sorted(event_list, key=lambda x: x["date"]):
-            if not full:
-                if (
-                    datetime.strptime(event["date"], "%Y-%m-%d").date()
-                    < datetime.now().date()
-                ):
-                    continue
-                if event.get("hidden", False):
-                    continue
+        rows = {}
+        doc_ids, first, last = self._page(full, cursor)
+        for doc_id in doc_ids:
+            event = events.get_doc(doc_id)
+            if not full and event.get("hidden", False):
+                continue
             name = event["name"]
-            date = datetime.strptime(event["date"], "%Y-%m-%d").strftime("%a %d.%b")
+            day = dates.label(event)
             time = event["time"]
-            free_places = event["capacity"] - len(event["registered_users"])
+            free_places = event["capacity"] - event.get("taken", 0)
             if event["capacity"] != 0 and free_places == 0:
                 mark = "🚫"
             else:
                 mark = "🆓"
-            if cmd == "register" and username in event["registered_users"]:
-                keyboard.append(
-                    [
-                        InlineKeyboardButton(
-                            f"✅[{free_places}] {name} {date} {time}",
-                            callback_data=f"unregister {event['id']}",
-                        ),
-                    ]
-                )
-            else:
-                keyboard.append(
-                    [
+            label = f"[{free_places}] {name} {day} {time}"
+            rows[event["id"]] = (len(keyboard), label)
+            keyboard.append(
+                [
+                    InlineKeyboardButton(
+                        text=f"{mark}{label}",
+                        callback_data=callbacks.encode(cmd, event["id"]),
+                    ),
+                ]
+            )
+        if nav := page_buttons(LIST_ACTIONS[cmd], (self.id,), first, last):
+            keyboard.append(nav)
+        if not cursor:
+            self._events_cache[(cmd, full)] = ((version, today), keyboard, rows)
+        logger.debug("Rebuilt %d event rows for %r", len(keyboard), self)
+        return keyboard, rows
+
+    async def all_events(self, cmd=None, full=False, username=None, cursor=()):
+        keyboard, rows = self._event_rows(cmd, full, cursor)
+        if cmd == "register" and username:
+            # Events the user is registered for are patched per request
+            keyboard = list(keyboard)
+            for doc_id in registrations.doc_ids("username", username):
+                (event_id,) = registrations.peek_doc(doc_id, "event_id")
+                if event_id in rows:
+                    position, label = rows[event_id]
+                    keyboard[position] = [
                         InlineKeyboardButton(
-                            text=f"{mark}[{free_places}] {name} {date} {time}",
-                            callback_data=f"{cmd} {event['id']}",
+                            f"✅{label}",
+                            callback_data=callbacks.encode("unregister", event_id),
                         ),
                     ]
-                )
         reply_markup = InlineKeyboardMarkup(keyboard)
         text = f"Список предстоящих мероприятий {self.name}:"
-        logger.info("List of events %r", reply_markup)
         return text, reply_markup
 
     async def register_as_user(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ):
         user = update.effective_user.username
-        logger.info("register as user by %r in channel %r", user, self)
+        logger.info(
+            "Register as user %s in channel %s", update.effective_user.id, self.id
+        )
         if not user:
             text = (
                 "Для регистрации необходимо установить username в настройках телеграм"
             )
         else:
-            async with db_lock:
-                r = channels.search(Query().id == self.id)[0].get(
-                    "registered_users", []
+            async with db_locks.hold(locks.channel(self.id)):
+                added = await channels.add_item(self.id, "registered_users", user)
+            if not added:
+                await start(update, context)
+                return
+            msg_data = await media_registry.get(self.welcome_message())
+            keyboard = [
+                [
+                    InlineKeyboardButton(
+                        text="Записаться",
+                        callback_data=callbacks.encode("events", self.id),
+                    ),
+                ]
+            ]
+            reply = InlineKeyboardMarkup(keyboard)
+            if msg_data and msg_data["file_id"]:
+                await update.message.reply_photo(
+                    photo=msg_data["file_id"],
+                    caption=escape(msg_data["caption"]),
+                    parse_mode=ParseMode.MARKDOWN_V2,
+                    reply_markup=reply,
                 )
-                if user in r:
-                    await start(update, context)
-                    return
-                else:
-                    r.append(user)
-                    channels.update({"registered_users": r}, Query().id == self.id)
-                    ch = channels_obj[self.id]
-                    if msg_id := ch.welcome_message():
-                        try:
-                            msg_data = pickle.load(open(f"data/{msg_id}.pkl", "rb"))
-                        except Exception as e:
-                            logger.error(e, exc_info=True)
-                        else:
-                            logger.info("Send welcome message %r", msg_data)
-
-                    if msg_data:
-                        keyboard = [
-                            [
-                                InlineKeyboardButton(
-                                    text="Записаться",
-                                    callback_data=f"events {self.id}",
-                                ),
-                            ]
-                        ]
-                        reply = InlineKeyboardMarkup(keyboard)
-
-                        logger.info("DBG %r", escape(msg_data["msg"]))
-                        await update.message.reply_photo(
-                            photo=msg_data["photo"],
-                            caption=escape(msg_data["msg"]),
-                            parse_mode=ParseMode.MARKDOWN_V2,
-                            reply_markup=reply,
-                        )
-
-                        return
-                    else:
-                        await update.message.reply_text(text=text, reply_markup=reply, parse_mode=ParseMode.HTML)
-
-
-                    # text = f"Вы успешно зарегистрировались на канал {self.name} - для продолженния напишите /start"
+            else:
+                text = f"Вы успешно зарегистрировались на канал {self.name}"
+                await update.message.reply_text(
+                    text=text, reply_markup=reply, parse_mode=ParseMode.HTML
+                )
+            return
 
         await update.message.reply_text(text=text, parse_mode=ParseMode.HTML)
 
@@ -174,59 +290,70 @@ class Channel:
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ):
         user = update.effective_user.username
-        logger.info("register as admin by %r in channel %r", user, self)
+        logger.info(
+            "Register as admin %s in channel %s", update.effective_user.id, self.id
+        )
         if not user:
             text = (
                 "Для регистрации необходимо установить username в настройках телеграм"
             )
         else:
-            async with db_lock:
-                r = channels.search(Query().id == self.id)[0].get("admins", [])
-                if user in r:
-                    text = "Вы уже зарегистрированы как админ на канал"
-                else:
-                    r.append(user)
-                    channels.update({"admins": r}, Query().id == self.id)
-                    text = f"Вы успешно зарегистрировались как админ на канал {self.name} - для продолженния напишите /start"
+            async with db_locks.hold(locks.channel(self.id)):
+                added = await channels.add_item(self.id, "admins", user)
+            if not added:
+                text = "Вы уже зарегистрированы как админ на канал"
+            else:
+                text = f"Вы успешно зарегистрировались как админ на канал {self.name} - для продолженния напишите /start"
         await update.message.reply_text(text=text, parse_mode=ParseMode.HTML)
 
-    async def admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def admin(self):
         keyboard = [
             [
                 InlineKeyboardButton(
-                    "Добавить события", callback_data=f"add-event {self.id}"
+                    "Добавить события",
+                    callback_data=callbacks.encode("add-event", self.id),
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "Список событий",
+                    callback_data=callbacks.encode("list-event", self.id),
                 )
             ],
             [
                 InlineKeyboardButton(
-                    "Список событий", callback_data=f"list-event {self.id}"
+                    "Повторяющиеся события",
+                    callback_data=callbacks.encode("series", self.id),
                 )
             ],
             [
                 InlineKeyboardButton(
                     "Добавить или изменить welcome message",
-                    callback_data=f"add-message {self.id}",
+                    callback_data=callbacks.encode("add-message", self.id),
                 )
             ],
             [
                 InlineKeyboardButton(
-                    "Удалить welcome message", callback_data=f"del-message {self.id}"
+                    "Удалить welcome message",
+                    callback_data=callbacks.encode("del-message", self.id),
                 )
             ],
             [
                 InlineKeyboardButton(
                     "Добавить или изменить event-list message",
-                    callback_data=f"add-emessage {self.id}",
+                    callback_data=callbacks.encode("add-emessage", self.id),
                 )
             ],
             [
                 InlineKeyboardButton(
-                    "Удалить event-list message", callback_data=f"del-emessage {self.id}"
+                    "Удалить event-list message",
+                    callback_data=callbacks.encode("del-emessage", self.id),
                 )
             ],
             [
                 InlineKeyboardButton(
-                    "Удалить прошедшие события", callback_data=f"delete-old {self.id}"
+                    "Удалить прошедшие события",
+                    callback_data=callbacks.encode("delete-old", self.id),
                 )
             ],
         ]
@@ -235,10 +362,10 @@ class Channel:
         return f"Упправление событиями в {self.name}:", reply_markup
 
     def welcome_message(self):
-        return channels.get(Query().id == self.id).get("welcome_message")
+        return channels.peek(self.id, "welcome_message")[0]
 
     def event_list_message(self):
-        return channels.get(Query().id == self.id).get("event_list_message")
+        return channels.peek(self.id, "event_list_message")[0]
 
     def __repr__(self):
         return self.__str__()
@@ -249,7 +376,7 @@ async def start(update: Update, context: CallbackContext):
         del wait_for_message[update.message.chat_id]
 
     user = update.effective_user.username
-    logger.info("Start command by %r", user)
+    logger.info("Start by %s", update.effective_user.id, extra=logs.HOT)
     if not user:
         await update.message.reply_text(
             "Для регистрации необходимо установить username в настройках телеграм"
@@ -259,26 +386,29 @@ async def start(update: Update, context: CallbackContext):
     keyboard = []
     was_admin = False
     only_channel = None
-    for channel in channels.all():
-        if user in channel.get("registered_users", []):
+    subscribed = channels.doc_ids("registered_users", user)
+    administered = channels.doc_ids("admins", user)
+    for doc_id in sorted(subscribed | administered):
+        channel_id, name = channels.peek_doc(doc_id, "id", "name")
+        if doc_id in subscribed:
             keyboard.append(
                 [
                     InlineKeyboardButton(
-                        channel["name"], callback_data=f"events {channel["id"]}"
+                        name, callback_data=callbacks.encode("events", channel_id)
                     )
                 ]
             )
             if only_channel is None:
-                only_channel = channel["id"]
+                only_channel = channel_id
             else:
                 only_channel = False
-        if user in channel.get("admins", []):
+        if doc_id in administered:
             was_admin = True
             keyboard.append(
                 [
                     InlineKeyboardButton(
-                        f"адм. {channel["name"]}",
-                        callback_data=f"admin {channel["id"]}",
+                        f"адм. {name}",
+                        callback_data=callbacks.encode("admin", channel_id),
                     )
                 ]
             )
@@ -288,7 +418,7 @@ async def start(update: Update, context: CallbackContext):
             [
                 InlineKeyboardButton(
                     f"настройки бота",
-                    callback_data="settings",
+                    callback_data=callbacks.encode("settings"),
                 )
             ],
         )
@@ -296,7 +426,7 @@ async def start(update: Update, context: CallbackContext):
             [
                 InlineKeyboardButton(
                     f"Добавить канал",
-                    callback_data="add-channel",
+                    callback_data=callbacks.encode("add-channel"),
                 )
             ],
         )
@@ -314,29 +444,22 @@ async def start(update: Update, context: CallbackContext):
 
     if only_channel:
         ch = channels_obj[only_channel]
-        if msg_id := ch.event_list_message():
-            try:
-                msg_data = pickle.load(open(f"data/{msg_id}.pkl", "rb"))
-            except Exception as e:
-                logger.error(e, exc_info=True)
-            else:
-                logger.info("Send welcome message %r", msg_data)
+        msg_data = await media_registry.get(ch.event_list_message())
         text, reply = await ch.all_events(cmd="register", username=user)
-        if msg_data:
+        if msg_data and msg_data["file_id"]:
             await update.message.reply_photo(
-                photo=msg_data["photo"],
+                photo=msg_data["file_id"],
                 caption=escape(text),
                 parse_mode=ParseMode.MARKDOWN_V2,
                 reply_markup=reply,
             )
         else:
-            await update.message.reply_text(text=text, reply_markup=reply_markup)
+            await update.message.reply_text(text=text, reply_markup=reply)
 
-    elif photo := settings.get(Query().name == "base_image"):
-        if photo_id := photo.get("value"):
-            photo_data = pickle.load(open(f"data/{photo_id}.pkl", "rb"))
+    elif photo := settings.get("base_image"):
+        if photo_data := await media_registry.get(photo.get("value")):
             await update.message.reply_photo(
-                photo=photo_data,
+                photo=photo_data["file_id"],
                 caption=text,
                 parse_mode="markdown",
                 reply_markup=reply_markup,
@@ -345,6 +468,26 @@ async def start(update: Update, context: CallbackContext):
         await update.message.reply_text(text=text, reply_markup=reply_markup)
 
 
+def start_route(token):
+    """Resolves a /start deep-link token to (channel, role)."""
+    for field, role in (("token", "user"), ("admin_token", "admin")):
+        for doc_id in channels.doc_ids(field, token):
+            (channel_id,) = channels.peek_doc(doc_id, "id")
+            return channels_obj[channel_id], role
+    return None, None
+
+
+@metrics.instrument("handler_seconds", handler="start")
+async def start_command(update: Update, context: CallbackContext):
+    if context.args:
+        ch, role = start_route(context.args[0])
+        if role == "user":
+            return await ch.register_as_user(update, context)
+        if role == "admin":
+            return await ch.register_as_admin(update, context)
+    await start(update, context)
+
+
 def escape(text):
     if text is None:
         return
@@ -362,54 +505,62 @@ async def event_show_change(event):
     keyboard = [
         [
             InlineKeyboardButton(
-                "Изменить название", callback_data=f"change-event {event['id']} name"
+                "Изменить название",
+                callback_data=callbacks.encode("event-name", event["id"]),
             )
         ],
         [
             InlineKeyboardButton(
-                "Изменить дату", callback_data=f"change-event {event['id']} date"
+                "Изменить дату",
+                callback_data=callbacks.encode("event-date", event["id"]),
             )
         ],
         [
             InlineKeyboardButton(
-                "Изменить время", callback_data=f"change-event {event['id']} time"
+                "Изменить время",
+                callback_data=callbacks.encode("event-time", event["id"]),
             )
         ],
         [
             InlineKeyboardButton(
                 "Изменить количество мест",
-                callback_data=f"change-event {event['id']} capacity",
+                callback_data=callbacks.encode("event-capacity", event["id"]),
             )
         ],
         [
             InlineKeyboardButton(
                 "Изменить/добавить notifycation message",
-                callback_data=f"change-event {event['id']} message",
+                callback_data=callbacks.encode("event-message", event["id"]),
             )
         ],
         [
             InlineKeyboardButton(
-                "Добавить участника", callback_data=f"change-event {event['id']} add"
+                "Добавить участника",
+                callback_data=callbacks.encode("event-add", event["id"]),
             )
         ],
         [
             InlineKeyboardButton(
-                "Удалить участника", callback_data=f"change-event {event['id']} remove"
+                "Удалить участника",
+                callback_data=callbacks.encode("event-remove", event["id"]),
             )
         ],
         [
             InlineKeyboardButton(
-                "Скрыть событие", callback_data=f"change-event {event['id']} hidden"
+                "Скрыть событие",
+                callback_data=callbacks.encode("event-hidden", event["id"]),
             )
         ],
         [
             InlineKeyboardButton(
-                "Удалить событие", callback_data=f"change-event {event['id']} delete"
+                "Удалить событие",
+                callback_data=callbacks.encode("event-delete", event["id"]),
             )
         ],
         [
             InlineKeyboardButton(
-                "🔙 К списку", callback_data=f"list-event {event["channel_id"]}"
+                "🔙 К списку",
+                callback_data=callbacks.encode("list-event", event["channel_id"]),
             )
         ],
     ]
@@ -418,42 +569,77 @@ async def event_show_change(event):
     дата:\t*{event["date"]}*
     время:\t*{event["time"]}*
     мест:\t*{event["capacity"]}*
-    занято:\t*{len(event["registered_users"])}*
-    кто записан:\t{', '.join([f'@{name}' for name in event["registered_users"]])}
+    занято:\t*{event.get("taken", 0)}*
+    кто записан:\t{', '.join([f'@{name}' for name in registered_users(event["id"])])}
     событие *{'скрыто' if event.get("hidden", False) else 'открыто'}*
 """
     return text, reply_markup
 
 
-async def send_notification(context):
-    logger.info("Send notification %r", context)
-    now = datetime.now()
-    logger.info("Now %r", now)
-    # 15:00 UTC
-    if now.hour < 15:
-        return
-    for n in notification.search(Query().date == now.date().isoformat()):
-        logger.info("Notification %r", n)
-        event = events.get(Query().id == n["event_id"])
-        logger.info("Event %r", event)
+def notification_job(n, event, msg_data):
+    async def job(sender):
         text = f"Напоминание о событии {event['name']} {event['date']} {event['time']}"
-        await context.bot.send_message(chat_id=n["chat_id"], text=text)
-        if msg_id := event.get("welcome_message"):
+        await sender.call("send_message", n["chat_id"], text=text)
+        if msg_data:
             try:
-                msg_data = pickle.load(open(f"data/{msg_id}.pkl", "rb"))
+                if msg_data["file_id"]:
+                    await sender.call(
+                        "send_photo",
+                        n["chat_id"],
+                        photo=msg_data["file_id"],
+                        caption=msg_data["caption"],
+                    )
+                else:
+                    await sender.call(
+                        "send_message", n["chat_id"], text=msg_data["caption"]
+                    )
             except Exception as e:
                 logger.error(e, exc_info=True)
-            else:
-                try:
-                    await context.bot.send_photo(
-                        chat_id=n["chat_id"],
-                        photo=msg_data["photo"],
-                        caption=msg_data["msg"],
-                    )
-                except Exception as e:
-                    logger.error(e, exc_info=True)
-        async with db_lock:
-            notification.remove(doc_ids=[n.doc_id])
+        return n.doc_id
+
+    return job
+
+
+@metrics.instrument("handler_seconds", handler="send_notification")
+async def send_notification(context, due):
+    logger.info("Send %d notifications", len(due))
+    jobs = []
+    job_ids = []
+    orphans = []
+    for n in due:
+        event = events.get(n["event_id"])
+        if event is None:
+            orphans.append(n.doc_id)
+            continue
+        msg_data = await media_registry.get(event.get("welcome_message"))
+        jobs.append(notification_job(n, event, msg_data))
+        job_ids.append(n.doc_id)
+    delivered = await dispatcher.Dispatcher(context.bot).run(jobs)
+    done = orphans + [doc_id for doc_id in delivered if doc_id is not None]
+    logger.info("Delivered %d of %d notifications", len(done) - len(orphans), len(jobs))
+    metrics.inc("notifications_sent_total", len(done) - len(orphans))
+    metrics.inc("notifications_failed_total", len(jobs) - len(done) + len(orphans))
+    async with db_locks.hold(*{locks.notification(n["event_id"]) for n in due}):
+        await notification.remove_doc_ids(done)
+    # Retried by the scheduler
+    return [job_id for job_id, doc_id in zip(job_ids, delivered) if doc_id is None]
+
+
+notification_scheduler = scheduler.NotificationScheduler(
+    notification, send_notification
+)
+
+
+async def flush_db(context):
+    await store.flush()
+
+
+async def compact_db(context):
+    await store.compact()
+
+
+async def close_db(application):
+    await store.compact()
 
 
 def event_return_back(event_id, channel_id):
@@ -462,28 +648,45 @@ def event_return_back(event_id, channel_id):
         keyboard.append(
             [
                 InlineKeyboardButton(
-                    "🔙 К события", callback_data=f"change-event {event_id}"
+                    "🔙 К события",
+                    callback_data=callbacks.encode("change-event", event_id),
                 )
             ]
         )
     keyboard.append(
-        [InlineKeyboardButton("🔙 К списку", callback_data=f"list-event {channel_id}")]
+        [
+            InlineKeyboardButton(
+                "🔙 К списку", callback_data=callbacks.encode("list-event", channel_id)
+            )
+        ]
     )
     reply_markup = InlineKeyboardMarkup(keyboard)
     return reply_markup
 
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.username not in SUPER_ADMINS:
+        return
+    await update.message.reply_text(metrics.registry.summary())
+
+
+async def start_metrics(application):
+    if metrics.METRICS_PORT:
+        await metrics.start_server()
+
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Displays info on how to use the bot."""
-    logger.info("Help command by %r %r", update.effective_user, update.message)
+    logger.info("Help by %s", update.effective_user.id)
     await update.message.reply_text("Use /start to test this bot.")
 
 
 async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle the inline query. This is run when you type: @botusername <query>"""
     query = update.inline_query.query
-    user_name = update.inline_query.from_user.username
-    logger.info("Inline query by %r data %r ", user_name, query)
+    logger.info(
+        "Inline query by %s, %d chars", update.inline_query.from_user.id, len(query)
+    )
     results = InlineQueryResultsButton(
         text="Записаться на событие",
         start_parameter="CMD_event_id_register",
@@ -492,230 +695,447 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.inline_query.answer([], button=results)
 
 
-def get_list_of_users(event):
+def get_list_of_users(event, cursor=()):
+    """Keyboard of one page of the event's participants.
+
+    ``cursor`` is empty or ``(direction, doc_id)`` of a registration.
+    """
     keyboard = []
-    for user in event["registered_users"]:
+    doc_ids = sorted(registrations.doc_ids("event_id", event["id"]))
+    if cursor and cursor[0] == PREV:
+        hi = bisect.bisect_left(doc_ids, cursor[1])
+        lo = max(hi - PAGE_SIZE, 0)
+    else:
+        lo = bisect.bisect_right(doc_ids, cursor[1]) if cursor else 0
+        hi = lo + PAGE_SIZE
+    page = doc_ids[lo:hi]
+    users = [registrations.peek_doc(doc_id, "username")[0] for doc_id in page]
+    for user in users:
         keyboard.append(
             [
                 InlineKeyboardButton(
                     f"Убрать {user}",
-                    callback_data=f"change-event {event['id']} remove-user {user}",
+                    callback_data=callbacks.encode(
+                        "event-remove-user", event["id"], user
+                    ),
                 )
             ]
         )
+    if page and (
+        nav := page_buttons(
+            "event-remove",
+            (event["id"],),
+            (page[0],) if lo > 0 else None,
+            (page[-1],) if hi < len(doc_ids) else None,
+        )
+    ):
+        keyboard.append(nav)
     keyboard.append(
         [
             InlineKeyboardButton(
-                "🔙 К событию", callback_data=f"change-event {event['id']}"
+                "🔙 К событию",
+                callback_data=callbacks.encode("change-event", event["id"]),
             )
         ],
     )
     keyboard.append(
         [
             InlineKeyboardButton(
-                "🔙 К списку", callback_data=f"list-event {event['channel_id']}"
+                "🔙 К списку",
+                callback_data=callbacks.encode("list-event", event["channel_id"]),
             )
         ]
     )
     reply_markup = InlineKeyboardMarkup(keyboard)
-    logger.info("List of users %r", reply_markup)
+    logger.debug("Users of event %s: %d", event["id"], len(users))
     return reply_markup
 
 
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Parses the CallbackQuery and updates the message text."""
-    query = update.callback_query
-    reply = None
-    data = query.data.split(" ")
-    user_name = query.from_user.username
-    msg_data = None
-    logger.info("Button pressed by %r data %r", user_name, data)
-    if data[0] == "add-event":
-        text = (
-            "Для добавления события отправьте сообщение в формате:\n"
-            "*Название события*@*дата в формате 2024-09-30*@"
-            "*время*@*количество свободных мест, числом*\n\n"
-            "Пример:\n"
-            "*Событие 1*@*2024-09-30*@*12:00*@*10*"
+def wait_for(query, type, **data):
+    wait_for_message[query.message.chat_id] = {"type": type, **data}
+
+
+async def import_events(channel_id, parsed):
+    """Inserts parsed events in one write, or none if any line is invalid.
+
+    Returns the reply text for the admin.
+    """
+    fields, errors = parsed
+    if errors:
+        return "Ошибки, события не добавлены:\n" + importer.error_report(errors)
+    if not fields:
+        return "Не найдено ни одного события"
+    async with db_locks.hold(locks.channel(channel_id), locks.table("events")):
+        ids = await events.next_ids(len(fields))
+        await events.insert_multiple(
+            {"id": id, **event, "taken": 0, "channel_id": int(channel_id)}
+            for id, event in zip(ids, fields)
         )
-        wait_for_message[query.message.chat_id] = {
-            "type": "add-event",
-            "channel_id": data[1],
-        }
-    elif data[0] == "events":
-        ch = channels_obj[int(data[1])]
-        if msg_id := ch.event_list_message():
-            try:
-                msg_data = pickle.load(open(f"data/{msg_id}.pkl", "rb"))
-            except Exception as e:
-                logger.error(e, exc_info=True)
-            else:
-                logger.info("Send welcome message %r", msg_data)
-        text, reply = await ch.all_events(cmd="register", username=user_name)
-    elif data[0] == "admin":
-        ch = channels_obj[int(data[1])]
-        text, reply = await ch.admin(update, context)
-    elif data[0] == "list-event":
-        ch = channels_obj[int(data[1])]
-        text, reply = await ch.all_events(cmd="change-event", full=True)
-    elif data[0] == "change-event":
-        event = events.get(Query().id == int(data[1]))
-        if len(data) > 2:
-            reply = event_return_back(data[1], event["channel_id"])
-            if data[2] == "name":
-                text = "Введите новое название события"
-                wait_for_message[query.message.chat_id] = {
-                    "type": "event-name",
-                    "event_id": data[1],
-                }
-            elif data[2] == "date":
-                text = "Введите новую дату события в формате 2024-09-30"
-                wait_for_message[query.message.chat_id] = {
-                    "type": "event-date",
-                    "event_id": data[1],
-                }
-            elif data[2] == "time":
-                text = "Введите новое время события"
-                wait_for_message[query.message.chat_id] = {
-                    "type": "event-time",
-                    "event_id": data[1],
-                }
-            elif data[2] == "capacity":
-                text = "Введите новое количество мест"
-                wait_for_message[query.message.chat_id] = {
-                    "type": "event-capacity",
-                    "event_id": data[1],
-                }
-            elif data[2] == "message":
-                text = "Для добавления event-message отправьте сообщение"
-                wait_for_message[query.message.chat_id] = {
-                    "type": "event-message",
-                    "event_id": data[1],
-                }
-            elif data[2] == "hidden":
-                async with db_lock:
-                    event = events.get(Query().id == int(data[1]))
-                    event["hidden"] = not event.get("hidden", False)
-                    events.update(event, Query().id == int(data[1]))
-                text = "Событие скрыто" if event["hidden"] else "Событие открыто"
-            elif data[2] == "delete":
-                channel_id = event["channel_id"]
-                async with db_lock:
-                    events.remove(Query().id == int(data[1]))
-                text = "Событие удалено"
-                reply = event_return_back(None, channel_id)
-            elif data[2] == "add":
-                text = "Введите username участника"
-                wait_for_message[query.message.chat_id] = {
-                    "type": "event-add",
-                    "event_id": data[1],
-                }
-            elif data[2] == "remove":
-                text = "Кого убрать?"
-                reply = get_list_of_users(event)
-            elif data[2] == "remove-user":
-                async with db_lock:
-                    event = events.get(Query().id == int(data[1]))
-                    event["registered_users"].remove(data[3])
-                    events.update(event, Query().id == int(data[1]))
-                text = f"Пользователь @{data[3]} удален"
-                reply = get_list_of_users(event)
-        else:
-            text, reply = await event_show_change(event)
-    elif data[0] == "register":
-        async with db_lock:
-            event = events.get(Query().id == int(data[1]))
-            if event["capacity"] == 0 or (
-                len(event["registered_users"]) < event["capacity"]
-            ):
-                user = query.from_user.username
-                if user not in event["registered_users"]:
-                    event["registered_users"].append(user)
-                    events.update(event, Query().id == int(data[1]))
-                    date = datetime.strptime(event["date"], "%Y-%m-%d").strftime("%a %d.%b")
-                    text = f"Вы успешно записались на событие {date} {event["time"]}"
-                    notify_date = datetime.fromisoformat(event["date"]) - timedelta(
-                        days=1
-                    )
-                    notification.insert_multiple(
-                        [
-                            {
-                                "event_id": event["id"],
-                                "chat_id": query.message.chat_id,
-                                "date": notify_date.date().isoformat(),
-                            },
-                        ]
-                    )
-                else:
-                    text = "Вы уже записаны на событие"
-            else:
-                text = "Все места на событие заняты"
-    elif data[0] == "unregister":
-        async with db_lock:
-            event = events.get(Query().id == int(data[1]))
+    logger.info("Imported %d events into channel %s", len(ids), channel_id)
+    return (
+        f"Добавлено событий: {len(ids)}. Вы можете отправить следующие события "
+        "или нажать /start для возврата в главное меню"
+    )
+
+
+@callbacks.handler("add-event")
+async def on_add_event(query, context, channel_id):
+    text = (
+        "Для добавления события отправьте сообщение в формате:\n"
+        "*Название события*@*дата в формате 2024-09-30*@"
+        "*время*@*количество свободных мест, числом*\n\n"
+        "Пример:\n"
+        "*Событие 1*@*2024-09-30*@*12:00*@*10*\n\n"
+        "Можно отправить несколько событий, по одному на строку, "
+        "или файл .csv (название, дата, время, места) или .ics"
+    )
+    wait_for(query, "add-event", channel_id=channel_id)
+    return text, None, None
+
+
+@callbacks.handler("events")
+async def on_events(query, context, channel_id, *cursor):
+    ch = channels_obj[int(channel_id)]
+    msg_data = await media_registry.get(ch.event_list_message())
+    text, reply = await ch.all_events(
+        cmd="register", username=query.from_user.username, cursor=cursor
+    )
+    return text, reply, msg_data
+
+
+@callbacks.handler("admin")
+async def on_admin(query, context, channel_id):
+    ch = channels_obj[int(channel_id)]
+    text, reply = await ch.admin()
+    return text, reply, None
+
+
+@callbacks.handler("list-event")
+async def on_list_event(query, context, channel_id, *cursor):
+    ch = channels_obj[int(channel_id)]
+    text, reply = await ch.all_events(cmd="change-event", full=True, cursor=cursor)
+    return text, reply, None
+
+
+# Old keyboards still carry buttons of archived or deleted events
+EVENT_GONE = "Событие уже прошло или удалено /start"
+
+
+def existing_event(fn):
+    """Answers with ``EVENT_GONE`` instead of running ``fn`` for a missing event."""
+
+    @functools.wraps(fn)
+    async def wrapper(query, context, event_id, *args):
+        if not events.has(int(event_id)):
+            return EVENT_GONE, None, None
+        return await fn(query, context, event_id, *args)
+
+    return wrapper
+
+
+@callbacks.handler("change-event")
+@existing_event
+async def on_change_event(query, context, event_id):
+    text, reply = await event_show_change(events.get(int(event_id)))
+    return text, reply, None
+
+
+EVENT_PROMPTS = {
+    "event-name": "Введите новое название события",
+    "event-date": "Введите новую дату события в формате 2024-09-30",
+    "event-time": "Введите новое время события",
+    "event-capacity": "Введите новое количество мест",
+    "event-message": "Для добавления event-message отправьте сообщение",
+    "event-add": "Введите username участника",
+}
+
+
+def event_prompt(name):
+    async def on_event_prompt(query, context, event_id):
+        (channel_id,) = events.peek(int(event_id), "channel_id")
+        wait_for(query, name, event_id=event_id)
+        return EVENT_PROMPTS[name], event_return_back(event_id, channel_id), None
+
+    return on_event_prompt
+
+
+for name in EVENT_PROMPTS:
+    callbacks.handler(name)(existing_event(event_prompt(name)))
+
+
+@callbacks.handler("event-hidden")
+@existing_event
+async def on_event_hidden(query, context, event_id):
+    async with db_locks.hold(locks.event(event_id)):
+        event = events.get(int(event_id))
+        event["hidden"] = not event.get("hidden", False)
+        await events.update(int(event_id), event)
+    text = "Событие скрыто" if event["hidden"] else "Событие открыто"
+    return text, event_return_back(event_id, event["channel_id"]), None
+
+
+@callbacks.handler("event-delete")
+@existing_event
+async def on_event_delete(query, context, event_id):
+    (channel_id,) = events.peek(int(event_id), "channel_id")
+    async with db_locks.hold(
+        locks.channel(channel_id),
+        locks.event(event_id),
+        locks.notification(event_id),
+    ):
+        await events.remove(int(event_id))
+        await registrations.remove_doc_ids(
+            registrations.doc_ids("event_id", int(event_id))
+        )
+        await notification.remove_doc_ids(
+            notification.doc_ids("event_id", int(event_id))
+        )
+    notification_scheduler.rearm()
+    return "Событие удалено", event_return_back(None, channel_id), None
+
+
+@callbacks.handler("event-remove")
+@existing_event
+async def on_event_remove(query, context, event_id, *cursor):
+    reply = get_list_of_users(events.get(int(event_id)), cursor)
+    return "Кого убрать?", reply, None
+
+
+@callbacks.handler("event-remove-user")
+@existing_event
+async def on_event_remove_user(query, context, event_id, user):
+    async with db_locks.hold(locks.event(event_id)):
+        await remove_registration(int(event_id), user)
+    event = events.get(int(event_id))
+    return f"Пользователь @{user} удален", get_list_of_users(event), None
+
+
+@callbacks.handler("register")
+async def on_register(query, context, event_id):
+    async with db_locks.hold(locks.event(event_id), locks.notification(event_id)):
+        event = events.get(int(event_id))
+        if event is None:
+            text = EVENT_GONE
+        elif event["capacity"] == 0 or event.get("taken", 0) < event["capacity"]:
             user = query.from_user.username
-            if user in event["registered_users"]:
-                event["registered_users"].remove(user)
-                events.update(event, Query().id == int(data[1]))
-                text = "Вы успешно отменили регистрацию на событие /start"
-                notification.remove(
-                    Query().fragment(
-                        {"event_id": event["id"], "chat_id": query.message.chat_id}
-                    )
+            if await add_registration(event["id"], user):
+                text = f"Вы успешно записались на событие {dates.label(event)} {event["time"]}"
+                notify_date = date.fromordinal(event["day"] - 1)
+                doc_ids = await notification.insert_multiple(
+                    [
+                        {
+                            "event_id": event["id"],
+                            "chat_id": query.message.chat_id,
+                            "date": notify_date.isoformat(),
+                        },
+                    ]
                 )
+                notification_scheduler.add(doc_ids)
             else:
-                text = "Вы небыли записаны на событие /start"
-    elif data[0] == "add-message":
-        text = "Отправьте фото и текст для welcome message"
-        wait_for_message[query.message.chat_id] = {
-            "type": "add-message",
-            "channel_id": data[1],
-        }
-    elif data[0] == "del-message":
-        async with db_lock:
-            channel = channels.get(Query().id == int(data["channel_id"]))
-            Path(f"data/{channel["welcome_message"]}.pkl").unlink(missing_ok=True)
-            channel["welcome_message"] = None
-            channels.update(channel, Query().id == int(data["channel_id"]))
+                text = "Вы уже записаны на событие"
+        else:
+            text = "Все места на событие заняты"
+    return text, None, None
+
+
+@callbacks.handler("unregister")
+@existing_event
+async def on_unregister(query, context, event_id):
+    async with db_locks.hold(locks.event(event_id), locks.notification(event_id)):
+        event = events.get(int(event_id))
+        user = query.from_user.username
+        if event is None:
+            text = EVENT_GONE
+        elif await remove_registration(event["id"], user):
+            text = "Вы успешно отменили регистрацию на событие /start"
+            await notification.remove_doc_ids(
+                [
+                    n.doc_id
+                    for n in notification.search("event_id", event["id"])
+                    if n["chat_id"] == query.message.chat_id
+                ]
+            )
+            notification_scheduler.rearm()
+        else:
+            text = "Вы небыли записаны на событие /start"
+    return text, None, None
+
+
+@callbacks.handler("add-message")
+async def on_add_message(query, context, channel_id):
+    wait_for(query, "add-message", channel_id=channel_id)
+    return "Отправьте фото и текст для welcome message", None, None
+
+
+@callbacks.handler("del-message")
+async def on_del_message(query, context, channel_id):
+    async with db_locks.hold(locks.channel(channel_id)):
+        channel = channels.get(int(channel_id))
+        await media_registry.delete(channel.get("welcome_message"))
+        channel["welcome_message"] = None
+        await channels.update(int(channel_id), channel)
+    return "Сообщение удалено", None, None
+
+
+@callbacks.handler("add-emessage")
+async def on_add_emessage(query, context, channel_id):
+    wait_for(query, "add-emessage", channel_id=channel_id)
+    return "Отправьте фото и текст для welcome message", None, None
+
+
+@callbacks.handler("del-emessage")
+async def on_del_emessage(query, context, channel_id):
+    async with db_locks.hold(locks.channel(channel_id)):
+        channel = channels.get(int(channel_id))
+        if channel.get("event_list_message"):
+            await media_registry.delete(channel["event_list_message"])
+            channel["event_list_message"] = None
+            await channels.update(int(channel_id), channel)
             text = "Сообщение удалено"
-    elif data[0] == "add-emessage":
-        text = "Отправьте фото и текст для welcome message"
-        wait_for_message[query.message.chat_id] = {
-            "type": "add-emessage",
-            "channel_id": data[1],
-        }
-    elif data[0] == "del-emessage":
-        async with db_lock:
-            channel = channels.get(Query().id == int(data["channel_id"]))
-            if channel.get("event_list_message"):
-                Path(f"data/{channel["event_list_message"]}.pkl").unlink(missing_ok=True)
-                channel["event_list_message"] = None
-                channels.update(channel, Query().id == int(data["channel_id"]))
-                text = "Сообщение удалено"
-            else:
-                text = "Сообщение не было установлено"
-    elif data[0] == "settings":
-        text = "Отправьте сообщение с картинкой для установки базового изображения"
-        wait_for_message[query.message.chat_id] = {
-            "type": "set-base-image",
-        }
-    elif data[0] == "add-channel":
-        text = "Отправьте сообщение с названием канала"
-        wait_for_message[query.message.chat_id] = {
-            "type": "add-channel",
-        }
+        else:
+            text = "Сообщение не было установлено"
+    return text, None, None
+
+
+@callbacks.handler("series")
+async def on_series(query, context, channel_id):
+    templates = channels.peek(int(channel_id), "series")[0] or []
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                f"❌ {series.label(template)}",
+                callback_data=callbacks.encode(
+                    "del-series", int(channel_id), template["id"]
+                ),
+            )
+        ]
+        for template in templates
+    ]
+    keyboard.append(
+        [
+            InlineKeyboardButton(
+                "Добавить", callback_data=callbacks.encode("add-series", channel_id)
+            )
+        ]
+    )
+    text = (
+        f"Повторяющиеся события, создаются на {series.SERIES_HORIZON_DAYS} "
+        "дней вперёд. Нажмите на событие, чтобы удалить его:"
+    )
+    return text, InlineKeyboardMarkup(keyboard), None
+
+
+@callbacks.handler("add-series")
+async def on_add_series(query, context, channel_id):
+    text = (
+        "Для добавления повторяющегося события отправьте сообщение в формате:\n"
+        "*Название*@*дни недели*@*время*@*количество свободных мест, числом*\n\n"
+        "Пример:\n"
+        "*Йога*@*пн,ср,пт*@*18:00*@*10*"
+    )
+    wait_for(query, "add-series", channel_id=channel_id)
+    return text, None, None
+
+
+@callbacks.handler("del-series")
+async def on_del_series(query, context, channel_id, series_id):
+    async with db_locks.hold(locks.channel(channel_id)):
+        templates = channels.get(int(channel_id)).get("series") or []
+        templates = [t for t in templates if t["id"] != int(series_id)]
+        await channels.update(int(channel_id), {"series": templates})
+    text = "Повторяющееся событие удалено, уже созданные события сохранены"
+    return text, None, None
+
+
+async def add_series(channel_id, text):
+    try:
+        template = series.parse(text)
+    except ValueError as e:
+        return f"{e}. Попробуйте ещё раз"
+    async with db_locks.hold(locks.channel(channel_id), locks.table("events")):
+        channel = channels.get(int(channel_id))
+        templates = channel.get("series") or []
+        # Ids of deleted series are not reused, their events keep them
+        template["id"] = 1 + max(
+            channel.get("series_seq", 0), *(t["id"] for t in templates), 0
+        )
+        await channels.update(
+            int(channel_id),
+            {"series": templates + [template], "series_seq": template["id"]},
+        )
+        count = await series.materialize(channels, events, int(channel_id))
+    return (
+        f"Повторяющееся событие добавлено, создано событий: {count}. "
+        "Нажмите /start для возврата в главное меню"
+    )
+
+
+async def materialize_series(context):
+    for channel_id in list(channels_obj):
+        async with db_locks.hold(locks.channel(channel_id), locks.table("events")):
+            await series.materialize(channels, events, channel_id)
+
+
+async def archive_channel(channel_id, before):
+    """Moves the channel's events dated before ``before`` to the archive."""
+    event_ids = archive.select(store, channel_id, before)
+    if not event_ids:
+        return 0
+    keys = [locks.event(id) for id in event_ids]
+    keys += [locks.notification(id) for id in event_ids]
+    async with db_locks.hold(locks.channel(channel_id), locks.table("events"), *keys):
+        count = await archive.move(store, event_ids)
+    notification_scheduler.rearm()
+    return count
+
+
+async def archive_old(context):
+    before = archive.cutoff()
+    for channel_id in list(channels_obj):
+        await archive_channel(channel_id, before)
+
+
+@callbacks.handler("delete-old")
+async def on_delete_old(query, context, channel_id):
+    count = await archive_channel(int(channel_id), date.today())
+    return f"Прошедших событий перенесено в архив: {count}", None, None
+
+
+@callbacks.handler("settings")
+async def on_settings(query, context):
+    wait_for(query, "set-base-image")
+    text = "Отправьте сообщение с картинкой для установки базового изображения"
+    return text, None, None
+
+
+@callbacks.handler("add-channel")
+async def on_add_channel(query, context):
+    wait_for(query, "add-channel")
+    return "Отправьте сообщение с названием канала", None, None
+
+
+async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Parses the CallbackQuery and updates the message text."""
+    query = update.callback_query
+    name, handler, args = callbacks.resolve(query.data)
+    logger.info("Button %s %s by %s", name, args, query.from_user.id, extra=logs.HOT)
+    if handler is not None:
+        with metrics.timed("handler_seconds", handler=f"button:{name}"):
+            text, reply, msg_data = await handler(query, context, *args)
     else:
-        logger.error("Unknown button %r", data)
-        text = f"Какая-то ошибка в обработке кнопки - начните с начала /start"
+        logger.error("Unknown button %r", query.data[:64])
+        metrics.inc("unknown_buttons_total")
+        text = "Какая-то ошибка в обработке кнопки - начните с начала /start"
+        reply = msg_data = None
 
     # CallbackQueries need to be answered, even if no notification to the user is needed
     # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
     await query.answer()
-    if msg_data:
+    if msg_data and msg_data["file_id"]:
         await query.edit_message_media(
             media=InputMediaPhoto(
-                media=msg_data["photo"].file_id,
-                caption=escape(msg_data["msg"]),
+                media=msg_data["file_id"],
+                caption=escape(msg_data["caption"]),
                 parse_mode=ParseMode.MARKDOWN_V2,
             ),
             reply_markup=reply,
@@ -736,53 +1156,64 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+@metrics.instrument("handler_seconds", handler="photo_process")
 async def photo_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(
-        "Message from %r: %r", update.effective_user.username, update.message.text
-    )
+    logger.info("Message from %s", update.effective_user.id, extra=logs.HOT)
     photo = update.message.photo[-1]
     msg = update.message.caption
     if update.message.chat_id in wait_for_message:
         data = wait_for_message[update.message.chat_id]
-        logger.info("Wait for message %r", data)
-        uuid = f"{uuid4()}"
+        logger.info("Wait for message %s", data["type"], extra=logs.HOT)
         if data["type"] == "add-message":
-            pickle.dump({"photo": photo, "msg": msg}, open(f"data/{uuid}.pkl", "wb"))
-            async with db_lock:
-                channel = channels.get(Query().id == int(data["channel_id"]))
+            uuid = await media_registry.save("welcome", photo.file_id, msg)
+            async with db_locks.hold(locks.channel(data["channel_id"])):
+                channel = channels.get(int(data["channel_id"]))
+                old_uuid = channel.get("welcome_message")
                 channel["welcome_message"] = uuid
-                channels.update(channel, Query().id == int(data["channel_id"]))
+                await channels.update(int(data["channel_id"]), channel)
+            await media_registry.delete(old_uuid)
             await context.bot.send_message(
                 chat_id=update.effective_chat.id, text="Сообщение сохранено"
             )
             return
         elif data["type"] == "add-emessage":
-            pickle.dump({"photo": photo, "msg": msg}, open(f"data/{uuid}.pkl", "wb"))
-            async with db_lock:
-                channel = channels.get(Query().id == int(data["channel_id"]))
+            uuid = await media_registry.save("event-list", photo.file_id, msg)
+            async with db_locks.hold(locks.channel(data["channel_id"])):
+                channel = channels.get(int(data["channel_id"]))
+                old_uuid = channel.get("event_list_message")
                 channel["event_list_message"] = uuid
-                channels.update(channel, Query().id == int(data["channel_id"]))
+                await channels.update(int(data["channel_id"]), channel)
+            await media_registry.delete(old_uuid)
             await context.bot.send_message(
                 chat_id=update.effective_chat.id, text="Сообщение сохранено"
             )
             return
         elif data["type"] == "set-base-image":
-            pickle.dump(photo, open(f"data/{uuid}.pkl", "wb"))
-            async with db_lock:
-                settings.upsert(
-                    {"name": "base_image", "value": uuid}, Query().name == "base_image"
-                )
+            uuid = await media_registry.save("base-image", photo.file_id, None)
+            async with db_locks.hold(locks.setting("base_image")):
+                old = settings.get("base_image")
+                await settings.upsert({"name": "base_image", "value": uuid})
+            if old:
+                await media_registry.delete(old.get("value"))
             await context.bot.send_message(
                 chat_id=update.effective_chat.id, text="Изображение сохранено"
             )
             return
         elif data["type"] == "event-message":
             event_id = data["event_id"]
-            pickle.dump({"photo": photo, "msg": msg}, open(f"data/{uuid}.pkl", "wb"))
-            async with db_lock:
-                event = events.get(Query().id == int(event_id))
+            uuid = await media_registry.save("event", photo.file_id, msg)
+            async with db_locks.hold(locks.event(event_id)):
+                event = events.get(int(event_id))
+                if event is None:
+                    await media_registry.delete(uuid)
+                    await context.bot.send_message(
+                        chat_id=update.effective_chat.id, text=EVENT_GONE
+                    )
+                    return
+                old_uuid = event.get("welcome_message")
                 event["welcome_message"] = uuid
-                events.update(event, Query().id == int(event_id))
+                await events.update(int(event_id), event)
+            await media_registry.delete(old_uuid)
             await context.bot.send_message(
                 chat_id=update.effective_chat.id, text="Сообщение сохранено"
             )
@@ -801,60 +1232,57 @@ async def photo_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@metrics.instrument("handler_seconds", handler="msg_process")
 async def msg_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(
-        "Message from %r: %r", update.effective_user.username, update.message.text
-    )
+    logger.info("Message from %s", update.effective_user.id, extra=logs.HOT)
     if update.message.chat_id in wait_for_message:
         data = wait_for_message[update.message.chat_id]
-        logger.info("Wait for message %r", data)
+        logger.info("Wait for message %s", data["type"], extra=logs.HOT)
         if data["type"] == "add-event":
-            msg_data = update.message.text.split("@")
-            try:
-                async with db_lock:
-                    event = {
-                        "id": get_next_id(events),
-                        "name": msg_data[0],
-                        "date": msg_data[1],
-                        "time": msg_data[2],
-                        "capacity": int(msg_data[3]),
-                        "registered_users": [],
-                        "channel_id": int(data["channel_id"]),
-                    }
-
-                    events.insert(event)
-                    text = "Событие успешно добавлено! Вы можете отправить следующее событие или нажать /start для возврата в главное меню"
-            except Exception as e:
-                logger.error(e)
-                text = f"Ошибка при добавлении события {e!r}"
+            text = await import_events(
+                data["channel_id"], importer.parse_text(update.message.text)
+            )
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text=text,
             )
             return
         elif data["type"].startswith("event-"):
-            async with db_lock:
-                event = events.get(Query().id == int(data["event_id"]))
-                if data["type"] == "event-name":
-                    event["name"] = update.message.text
-                elif data["type"] == "event-date":
-                    event["date"] = update.message.text
+            try:
+                if data["type"] == "event-date":
+                    fields = dates.date_fields(update.message.text)
                 elif data["type"] == "event-time":
-                    event["time"] = update.message.text
+                    fields = dates.time_fields(update.message.text)
                 elif data["type"] == "event-capacity":
-                    event["capacity"] = int(update.message.text)
+                    fields = {"capacity": importer.parse_capacity(update.message.text)}
+            except ValueError as e:
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id, text=f"{e}. Попробуйте ещё раз"
+                )
+                return
+            async with db_locks.hold(locks.event(data["event_id"])):
+                event = events.get(int(data["event_id"]))
+                if event is None:
+                    await context.bot.send_message(
+                        chat_id=update.effective_chat.id, text=EVENT_GONE
+                    )
+                    return
+                if data["type"] == "event-name":
+                    event["name"] = update.message.text
+                elif data["type"] in ("event-date", "event-time", "event-capacity"):
+                    event.update(fields)
                 elif data["type"] == "event-add":
                     user = update.message.text.replace("@", "")
-                    if user not in event["registered_users"]:
-                        event["registered_users"].append(user)
+                    await add_registration(event["id"], user)
+                    event = events.get(event["id"])
                 elif data["type"] == "event-message":
-                    uuid = f"{uuid4()}"
-                    pickle.dump(
-                        {"photo": None, "msg": update.message.text},
-                        open(f"data/{uuid}.pkl", "wb"),
+                    old_uuid = event.get("welcome_message")
+                    event["welcome_message"] = await media_registry.save(
+                        "event", None, update.message.text
                     )
-                    event["welcome_message"] = uuid
-                events.update(event, Query().id == int(data["event_id"]))
+                await events.update(int(data["event_id"]), event)
+                if data["type"] == "event-message":
+                    await media_registry.delete(old_uuid)
             text, reply = await event_show_change(event)
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -863,19 +1291,24 @@ async def msg_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.HTML,
             )
             return
+        elif data["type"] == "add-series":
+            text = await add_series(data["channel_id"], update.message.text)
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+            return
         elif data["type"] == "add-channel":
-            async with db_lock:
+            async with db_locks.hold(locks.table("channels")):
                 token = f"{uuid4()}"
                 admin_token = f"{uuid4()}"
                 channel = {
-                    "id": get_next_id(channels),
+                    "id": await channels.next_id(),
                     "name": update.message.text,
                     "registered_users": [],
                     "admins": [update.effective_user.username],
                     "token": token,
                     "admin_token": admin_token,
                 }
-                channels.insert(channel)
+                await channels.insert(channel)
+                channels_obj[channel["id"]] = Channel(channel["id"], channel["name"])
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="Канал успешно добавлен. \n Токен для регистрации: {token} \n Токен для администрирования: {admin_token}".format(
@@ -890,45 +1323,105 @@ async def msg_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
 
 
+@metrics.instrument("handler_seconds", handler="document_process")
+async def document_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Document from %s", update.effective_user.id, extra=logs.HOT)
+    data = wait_for_message.get(update.message.chat_id)
+    if data is None or data["type"] != "add-event":
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id, text="Для начала работы отправьте /start"
+        )
+        return
+    document = update.message.document
+    if document.file_size and document.file_size > importer.MAX_FILE_SIZE:
+        text = "Файл слишком большой"
+    else:
+        raw = await (await document.get_file()).download_as_bytearray()
+        try:
+            parsed = importer.parse_file(document.file_name, bytes(raw))
+        except UnicodeDecodeError:
+            text = "Файл должен быть в кодировке UTF-8"
+        else:
+            text = await import_events(data["channel_id"], parsed)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+
+
 # Main function to set up the bot
+def live_media():
+    live = {event.get("welcome_message") for event in events.all()}
+    for channel in channels.all():
+        live.add(channel.get("welcome_message"))
+        live.add(channel.get("event_list_message"))
+    if photo := settings.get("base_image"):
+        live.add(photo.get("value"))
+    return live
+
+
 def main():
+    store.load()
+    media_store.load()
+    media_store.compact(live_media())
     application = (
-        Application.builder().token(os.environ.get("TELEGRAM_BOT_TOKEN")).build()
+        Application.builder()
+        .token(os.environ.get("TELEGRAM_BOT_TOKEN"))
+        .post_init(start_metrics)
+        .post_shutdown(close_db)
+        .concurrent_updates(updates.ChatOrderedUpdateProcessor())
+        .build()
     )
 
     for channel in channels.all():
-        ch = Channel(channel["id"], channel["name"])
-        logger.info("%r register hooks", ch)
-        channels_obj[channel["id"]] = ch
-        application.add_handler(
-            CommandHandler(
-                "start", ch.register_as_user, filters.Regex(channel["token"])
-            )
-        )
-        application.add_handler(
-            CommandHandler(
-                "start", ch.register_as_admin, filters.Regex(channel["admin_token"])
-            )
-        )
+        channels_obj[channel["id"]] = Channel(channel["id"], channel["name"])
+    logger.info("Loaded %d channels", len(channels_obj))
 
-    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("start", start_command))
 
     application.add_handler(CallbackQueryHandler(button))
     application.add_handler(InlineQueryHandler(inline_query))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("stats", stats_command))
 
     # Command handlers
     msg_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), msg_process)
     photo_handler = MessageHandler(filters.PHOTO, photo_process)
+    document_handler = MessageHandler(filters.Document.ALL, document_process)
 
     application.add_handler(msg_handler)
     application.add_handler(photo_handler)
+    application.add_handler(document_handler)
 
     # Start the bot
-    application.job_queue.run_repeating(send_notification, interval=60, first=0)
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    notification_scheduler.start(application.job_queue)
+    if DB_BACKEND == "journal":
+        application.job_queue.run_repeating(flush_db, interval=DB_FLUSH_INTERVAL)
+    if DB_BACKEND != "tinydb":
+        application.job_queue.run_repeating(compact_db, interval=DB_COMPACT_INTERVAL)
+    application.job_queue.run_repeating(
+        materialize_series, interval=series.SERIES_INTERVAL, first=0
+    )
+    application.job_queue.run_repeating(
+        archive_old, interval=archive.ARCHIVE_INTERVAL, first=60
+    )
+    if BOT_MODE == "webhook":
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=WEBHOOK_URL,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
-    migration.apply()
+    logs.setup()
+    if DB_BACKEND == "sqlite":
+        # db.json is only read once, to be imported after its migrations
+        migration.apply()
+        store.recover()
+    else:
+        store.recover()
+        migration.apply()
     main()
@@ -0,0 +1,108 @@
+from datetime import date, datetime, time, timedelta
+import heapq
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Reminders go out the day before the event, from this hour on
+NOTIFY_HOUR = int(os.environ.get("NOTIFY_HOUR", 15))
+# First retry of an undelivered notification, doubled per attempt up to the max
+NOTIFY_RETRY_SECONDS = float(os.environ.get("NOTIFY_RETRY_SECONDS", 60))
+NOTIFY_RETRY_MAX_SECONDS = float(os.environ.get("NOTIFY_RETRY_MAX_SECONDS", 3600))
+
+
+def due_time(doc):
+    return datetime.combine(date.fromisoformat(doc["date"]), time(NOTIFY_HOUR))
+
+
+class NotificationScheduler:
+    """Min-heap of pending notifications driving a single JobQueue job.
+
+    Instead of polling the notification table, one ``run_once`` job is kept
+    armed for the earliest due time. ``add`` and ``rearm`` must be called
+    after notifications are inserted or removed; removed documents are
+    dropped lazily when they reach the top of the heap.
+    ``callback(context, docs)`` receives every document that is due and
+    returns the doc ids it could not deliver. Those are retried with a
+    growing delay until the end of the day, after which they are stale.
+    """
+
+    def __init__(self, table, callback):
+        self.table = table
+        self.callback = callback
+        self.job_queue = None
+        self._heap = []
+        self._job = None
+        self._job_due = None
+        self._attempts = {}
+
+    def start(self, job_queue):
+        self.job_queue = job_queue
+        self._heap = [(due_time(doc), doc.doc_id) for doc in self.table.all()]
+        heapq.heapify(self._heap)
+        logger.info("Scheduled %d notifications", len(self._heap))
+        self.rearm()
+
+    def add(self, doc_ids):
+        for doc_id in doc_ids:
+            heapq.heappush(self._heap, (due_time(self.table.get_doc(doc_id)), doc_id))
+        self.rearm()
+
+    def _drop_removed(self):
+        while self._heap and self.table.get_doc(self._heap[0][1]) is None:
+            heapq.heappop(self._heap)
+
+    def rearm(self):
+        if self.job_queue is None:
+            return
+        self._drop_removed()
+        due = self._heap[0][0] if self._heap else None
+        if due == self._job_due:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+        self._job_due = due
+        if due is not None:
+            delay = max((due - datetime.now()).total_seconds(), 0)
+            self._job = self.job_queue.run_once(self._run, delay)
+
+    async def _run(self, context):
+        self._job = None
+        self._job_due = None
+        now = datetime.now()
+        today = now.date()
+        docs = []
+        stale = []
+        while self._heap and self._heap[0][0] <= now:
+            _, doc_id = heapq.heappop(self._heap)
+            if (doc := self.table.get_doc(doc_id)) is None:
+                continue
+            if date.fromisoformat(doc["date"]) < today:
+                stale.append(doc_id)
+                self._attempts.pop(doc_id, None)
+            else:
+                docs.append(doc)
+        if stale:
+            logger.info("Drop %d notifications missed while offline", len(stale))
+            await self.table.remove_doc_ids(stale)
+        failed = [doc.doc_id for doc in docs]
+        try:
+            if docs:
+                failed = await self.callback(context, docs) or []
+        finally:
+            for doc_id in {doc.doc_id for doc in docs} - set(failed):
+                self._attempts.pop(doc_id, None)
+            self._retry(failed, now)
+            self.rearm()
+
+    def _retry(self, doc_ids, now):
+        for doc_id in doc_ids:
+            attempt = self._attempts.get(doc_id, 0)
+            self._attempts[doc_id] = attempt + 1
+            delay = min(NOTIFY_RETRY_SECONDS * 2**attempt, NOTIFY_RETRY_MAX_SECONDS)
+            due = min(
+                now + timedelta(seconds=delay), datetime.combine(now.date(), time.max)
+            )
+            heapq.heappush(self._heap, (due, doc_id))
@@ -0,0 +1,113 @@
+"""Recurring event series.
+
+A series is a template kept in the ``series`` list of its channel:
+``{"id", "name", "weekdays", "time", "minutes", "capacity", "since",
+"until"}`` with weekdays 0 (Monday) to 6 and ``since``/``until`` day
+ordinals. Concrete events, which hold the registrations, are only created
+``SERIES_HORIZON_DAYS`` ahead by ``materialize``. ``until`` is the last day
+already materialized, so an instance deleted by an admin is not created
+again. Ids come from the channel's ``series_seq`` counter and are never
+reused, events keep the ``series_id`` of a deleted series.
+"""
+
+from datetime import date, timedelta
+import dates
+import importer
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Days ahead for which events of a series exist
+SERIES_HORIZON_DAYS = int(os.environ.get("SERIES_HORIZON_DAYS", 14))
+# Seconds between runs of the materializing job
+SERIES_INTERVAL = float(os.environ.get("SERIES_INTERVAL", 3600))
+
+WEEKDAYS = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+
+
+def parse_weekdays(text):
+    weekdays = set()
+    for item in text.replace(" ", "").lower().split(","):
+        if item.isdigit() and 1 <= int(item) <= 7:
+            weekdays.add(int(item) - 1)
+        elif item[:2] in WEEKDAYS:
+            weekdays.add(WEEKDAYS.index(item[:2]))
+        else:
+            raise ValueError(f"Неверный день недели {item!r}, ожидается пн,ср,пт")
+    return sorted(weekdays)
+
+
+def parse(text, today=None):
+    """Parses ``name@weekdays@time@capacity`` into a template without id."""
+    fields = text.split("@")
+    if len(fields) != 4:
+        raise ValueError("Ожидается формат Название@пн,чт@время@количество мест")
+    name, weekdays, time, capacity = fields
+    if not name.strip():
+        raise ValueError("Пустое название")
+    today = today or date.today()
+    return {
+        "name": name.strip(),
+        "weekdays": parse_weekdays(weekdays),
+        **dates.time_fields(time),
+        "capacity": importer.parse_capacity(capacity),
+        "since": today.toordinal(),
+        "until": today.toordinal() - 1,
+    }
+
+
+def label(template):
+    days = ",".join(WEEKDAYS[day] for day in template["weekdays"])
+    return f"{template['name']} {days} {template['time']}"
+
+
+def occurrences(template, stop):
+    """Days after ``until`` up to and including ``stop`` the series meets on."""
+    first = max(template["until"] + 1, template["since"])
+    return [
+        day
+        for day in range(first, stop + 1)
+        if date.fromordinal(day).weekday() in template["weekdays"]
+    ]
+
+
+async def materialize(channels, events, channel_id, today=None):
+    """Creates the channel's series events up to the horizon.
+
+    Callers hold the channel and events locks. Returns the number of
+    events created.
+    """
+    channel = channels.get(channel_id)
+    templates = channel.get("series") if channel else None
+    if not templates:
+        return 0
+    today = today or date.today()
+    stop = (today + timedelta(days=SERIES_HORIZON_DAYS)).toordinal()
+    new = []
+    changed = False
+    for template in templates:
+        for day in occurrences(template, stop):
+            new.append(
+                {
+                    "name": template["name"],
+                    **dates.date_fields(date.fromordinal(day).isoformat()),
+                    "time": template["time"],
+                    "minutes": template["minutes"],
+                    "capacity": template["capacity"],
+                    "taken": 0,
+                    "channel_id": channel_id,
+                    "series_id": template["id"],
+                }
+            )
+        if template["until"] < stop:
+            template["until"] = stop
+            changed = True
+    if new:
+        ids = await events.next_ids(len(new))
+        await events.insert_multiple({"id": id, **event} for id, event in zip(ids, new))
+    if changed:
+        await channels.update(channel_id, {"series": templates})
+    if new:
+        logger.info("Created %d series events in channel %s", len(new), channel_id)
+    return len(new)
@@ -0,0 +1,978 @@
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import deepcopy
+from pathlib import Path
+from tinydb import TinyDB
+from tinydb.storages import Storage
+from tinydb.table import Document
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import metrics
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+IO_WORKERS = int(os.environ.get("IO_WORKERS", 4))
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+
+# Warn when loading the database at startup takes longer than this
+DB_LOAD_WARN_SECONDS = float(os.environ.get("DB_LOAD_WARN_SECONDS", 5))
+
+
+async def run_io(fn, *args):
+    """Runs blocking file I/O in the bounded I/O pool."""
+    return await asyncio.get_running_loop().run_in_executor(io_executor, fn, *args)
+
+
+class CorruptSnapshotError(ValueError):
+    pass
+
+
+def fsync_dir(path):
+    fd = os.open(Path(path).parent, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path, raw):
+    """Replaces ``path`` with ``raw`` so a crash leaves the old or new file."""
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(path)
+
+
+def checksum_path(path):
+    return Path(f"{path}.sha256")
+
+
+def _checksum(raw):
+    return f"{hashlib.sha256(raw).hexdigest()} {len(raw)}\n".encode()
+
+
+def _current_checksum(path):
+    sidecar = checksum_path(path)
+    if sidecar.exists():
+        return sidecar.read_bytes().split(b"\n")[0] + b"\n"
+    if path.exists():
+        return _checksum(path.read_bytes())
+    return b""
+
+
+def write_snapshot(path, data):
+    """Writes ``data`` as JSON atomically, with a ``.sha256`` sidecar.
+
+    The sidecar is replaced first and lists the new checksum followed by
+    the one of the snapshot being replaced, so whichever of the two files
+    a crash leaves on disk still matches it.
+    """
+    path = Path(path)
+    raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    write_atomic(checksum_path(path), _checksum(raw) + _current_checksum(path))
+    write_atomic(path, raw)
+
+
+def validate_snapshot(path):
+    """Checks ``path`` against its sidecar, returns the raw bytes.
+
+    Raises ``CorruptSnapshotError`` unless the snapshot matches one of the
+    sidecar's checksums. A match on the older one means a crash kept the
+    old snapshot; the sidecar is rewritten to it, as ``write_snapshot``
+    takes the first line for the snapshot on disk. A snapshot without a
+    sidecar predates checksums: it is accepted if it parses, and the
+    sidecar is created.
+    """
+    path = Path(path)
+    if not path.exists():
+        return b""
+    raw = path.read_bytes()
+    sidecar = checksum_path(path)
+    if sidecar.exists():
+        checksums = sidecar.read_bytes().split(b"\n")
+        current = _checksum(raw)
+        if current.rstrip() not in checksums:
+            raise CorruptSnapshotError(f"{path} does not match its checksum")
+        if checksums[0] != current.rstrip():
+            logger.warning("%s is the snapshot before a crash", path)
+            write_atomic(sidecar, current)
+        return raw
+    try:
+        if raw:
+            json.loads(raw)
+    except ValueError as e:
+        raise CorruptSnapshotError(f"{path} is corrupt: {e}") from e
+    logger.warning("%s has no checksum yet, creating it", path)
+    write_atomic(sidecar, _checksum(raw))
+    return raw
+
+
+class AtomicJSONStorage(Storage):
+    """TinyDB storage that never rewrites db.json in place.
+
+    Every write goes to a temporary file which is fsynced and renamed over
+    the database, followed by its checksum sidecar.
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = Path(path)
+
+    def read(self):
+        if not self.path.exists() or not self.path.stat().st_size:
+            return None
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def write(self, data):
+        write_snapshot(self.path, data)
+
+    def close(self):
+        pass
+
+
+class TinyDBBackend:
+    """Write-through persistence: every mutation is written to db.json."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.db = TinyDB(path, storage=AtomicJSONStorage)
+
+    def recover(self):
+        validate_snapshot(self.path)
+
+    def read(self, name):
+        return {doc.doc_id: dict(doc) for doc in self.db.table(name).all()}
+
+    def insert(self, name, docs):
+        self.db.table(name).insert_multiple(
+            [Document(doc, doc_id=doc_id) for doc_id, doc in docs.items()]
+        )
+
+    def update(self, name, doc_id, fields):
+        self.db.table(name).update(fields, doc_ids=[doc_id])
+
+    def remove(self, name, doc_ids):
+        self.db.table(name).remove(doc_ids=doc_ids)
+
+    def add_item(self, name, doc_id, field, value):
+        self.db.table(name).update(
+            lambda doc: doc.setdefault(field, []).append(value), doc_ids=[doc_id]
+        )
+
+    def flush(self):
+        pass
+
+    def compact(self):
+        pass
+
+
+class JournalBackend:
+    """Write-behind persistence for db.json.
+
+    Mutations are buffered and appended to ``<path>.journal`` as JSON lines
+    by ``flush``, which fsyncs once per batch. ``compact`` folds the journal
+    into the TinyDB-compatible snapshot at ``path``, so the other scripts
+    keep working on db.json after a compaction.
+    """
+
+    def __init__(self, path, flush_records=100, compact_bytes=1024 * 1024):
+        self.path = Path(path)
+        self.journal_path = Path(f"{path}.journal")
+        self.flush_records = flush_records
+        self.compact_bytes = compact_bytes
+        self._pending = []
+        self._snapshot = None
+
+    def _read_snapshot(self):
+        raw = validate_snapshot(self.path)
+        return json.loads(raw) if raw else {}
+
+    def _replay(self, data):
+        if not self.journal_path.exists():
+            return 0
+        count = 0
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn tail of a crashed append, nothing after it is valid
+                    logger.warning("Journal truncated after %d records", count)
+                    break
+                table = data.setdefault(record["table"], {})
+                if record["op"] == "insert":
+                    table.update(record["docs"])
+                elif record["op"] == "update":
+                    table.get(str(record["doc_id"]), {}).update(record["fields"])
+                elif record["op"] == "remove":
+                    for doc_id in record["doc_ids"]:
+                        table.pop(str(doc_id), None)
+                elif record["op"] == "add_item":
+                    doc = table.get(str(record["doc_id"]), {})
+                    doc.setdefault(record["field"], []).append(record["value"])
+                count += 1
+        return count
+
+    def _write_snapshot(self, data):
+        write_snapshot(self.path, data)
+
+    def recover(self):
+        self.compact()
+        # Migrations rewrite db.json after recovery, ``read`` must see that
+        self._snapshot = None
+
+    def read(self, name):
+        if self._snapshot is None:
+            self._write_pending()
+            self._snapshot = self._read_snapshot()
+            self._replay(self._snapshot)
+        return {
+            int(doc_id): doc for doc_id, doc in self._snapshot.get(name, {}).items()
+        }
+
+    def _append(self, record):
+        self._snapshot = None
+        self._pending.append(record)
+        if len(self._pending) >= self.flush_records:
+            self.flush()
+
+    def insert(self, name, docs):
+        docs = {str(doc_id): doc for doc_id, doc in docs.items()}
+        self._append({"op": "insert", "table": name, "docs": docs})
+
+    def update(self, name, doc_id, fields):
+        self._append(
+            {"op": "update", "table": name, "doc_id": doc_id, "fields": fields}
+        )
+
+    def remove(self, name, doc_ids):
+        self._append({"op": "remove", "table": name, "doc_ids": list(doc_ids)})
+
+    def add_item(self, name, doc_id, field, value):
+        self._append(
+            {
+                "op": "add_item",
+                "table": name,
+                "doc_id": doc_id,
+                "field": field,
+                "value": value,
+            }
+        )
+
+    def _write_pending(self):
+        if not self._pending:
+            return
+        lines = "".join(
+            json.dumps(record, ensure_ascii=False) + "\n" for record in self._pending
+        )
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = []
+
+    def flush(self):
+        self._write_pending()
+        if (
+            self.journal_path.exists()
+            and self.journal_path.stat().st_size >= self.compact_bytes
+        ):
+            self.compact()
+
+    def compact(self):
+        self._write_pending()
+        data = self._read_snapshot()
+        count = self._replay(data)
+        if count or not self.path.exists():
+            self._write_snapshot(data)
+            logger.info("Compacted %d journal records into %s", count, self.path)
+        self.journal_path.unlink(missing_ok=True)
+        self._snapshot = data
+
+
+# Fields kept in their own indexed columns, next to the full JSON document
+SQLITE_COLUMNS = {
+    "events": ("id", "channel_id", "day", "minutes"),
+    "channels": ("id", "token", "admin_token"),
+    "notification": ("event_id", "chat_id", "date"),
+    "settings": ("name",),
+    "registrations": ("event_id", "username"),
+}
+# List fields normalized into (doc_id, username) tables
+SQLITE_LISTS = {
+    "channels": {"registered_users": "subscribers", "admins": "admins"},
+}
+# Schema migrations, the database's user_version counts the applied ones
+SQLITE_SCHEMA = [
+    """
+    CREATE TABLE events (
+        doc_id INTEGER PRIMARY KEY,
+        id INTEGER,
+        channel_id INTEGER,
+        day INTEGER,
+        minutes INTEGER,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX events_id ON events (id);
+    CREATE INDEX events_channel ON events (channel_id, day, minutes);
+    CREATE TABLE registrations (
+        doc_id INTEGER NOT NULL REFERENCES events ON DELETE CASCADE,
+        username TEXT NOT NULL,
+        UNIQUE (doc_id, username)
+    );
+    CREATE INDEX registrations_username ON registrations (username);
+    CREATE TABLE channels (
+        doc_id INTEGER PRIMARY KEY,
+        id INTEGER,
+        token TEXT,
+        admin_token TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX channels_id ON channels (id);
+    CREATE INDEX channels_token ON channels (token);
+    CREATE INDEX channels_admin_token ON channels (admin_token);
+    CREATE TABLE subscribers (
+        doc_id INTEGER NOT NULL REFERENCES channels ON DELETE CASCADE,
+        username TEXT NOT NULL,
+        UNIQUE (doc_id, username)
+    );
+    CREATE INDEX subscribers_username ON subscribers (username);
+    CREATE TABLE admins (
+        doc_id INTEGER NOT NULL REFERENCES channels ON DELETE CASCADE,
+        username TEXT NOT NULL,
+        UNIQUE (doc_id, username)
+    );
+    CREATE INDEX admins_username ON admins (username);
+    CREATE TABLE notification (
+        doc_id INTEGER PRIMARY KEY,
+        event_id INTEGER,
+        chat_id INTEGER,
+        date TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX notification_date ON notification (date);
+    CREATE INDEX notification_event_id ON notification (event_id);
+    CREATE TABLE settings (
+        doc_id INTEGER PRIMARY KEY,
+        name TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX settings_name ON settings (name);
+    CREATE TABLE media (
+        uuid TEXT PRIMARY KEY,
+        kind TEXT,
+        file_id TEXT,
+        caption TEXT
+    );
+    -- Any other table of the document store
+    CREATE TABLE docs (
+        name TEXT NOT NULL,
+        doc_id INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (name, doc_id)
+    );
+    CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+    """,
+    # Event user lists become registration documents and a taken counter
+    """
+    ALTER TABLE registrations RENAME TO event_users;
+    DROP INDEX registrations_username;
+    CREATE TABLE registrations (
+        doc_id INTEGER PRIMARY KEY,
+        event_id INTEGER,
+        username TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE UNIQUE INDEX registrations_key ON registrations (event_id, username);
+    CREATE INDEX registrations_username ON registrations (username);
+    INSERT INTO registrations (event_id, username, data)
+        SELECT events.id, event_users.username,
+            json_object('event_id', events.id, 'username', event_users.username)
+        FROM event_users JOIN events USING (doc_id)
+        ORDER BY event_users.rowid;
+    UPDATE events SET data = json_set(
+        json_remove(data, '$.registered_users'),
+        '$.taken',
+        (SELECT count(*) FROM event_users WHERE event_users.doc_id = events.doc_id)
+    );
+    DROP TABLE event_users;
+    """,
+    # Due notifications are found through the scheduler's heap
+    """
+    DROP INDEX notification_date;
+    """,
+]
+
+
+def sqlite_connect(path):
+    """Opens ``path`` in WAL mode and brings its schema up to date."""
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        for number, script in enumerate(SQLITE_SCHEMA[version:], version + 1):
+            for statement in filter(str.strip, script.split(";")):
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version={number}")
+            logger.info("Applied SQLite schema %d to %s", number, path)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return conn
+
+
+@contextmanager
+def transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+class SQLiteBackend:
+    """Persistence in a SQLite database in WAL mode.
+
+    Each mutation is one transaction. Documents are stored as JSON next to
+    indexed copies of ``SQLITE_COLUMNS``; the ``SQLITE_LISTS`` fields live
+    only in their own tables. On first start ``recover`` imports
+    ``import_path`` (a TinyDB file) in a single transaction.
+    """
+
+    def __init__(self, path, import_path=None):
+        self.path = Path(path)
+        self.import_path = Path(import_path) if import_path else None
+        self.conn = sqlite_connect(self.path)
+
+    def recover(self):
+        (result,) = self.conn.execute("PRAGMA quick_check").fetchone()
+        if result != "ok":
+            raise CorruptSnapshotError(f"{self.path} is corrupt: {result}")
+        imported = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'imported'"
+        ).fetchone()
+        if imported or self.import_path is None or not self.import_path.exists():
+            return
+        with open(self.import_path, encoding="utf-8") as f:
+            data = json.load(f)
+        with transaction(self.conn):
+            for name, docs in data.items():
+                self._insert(name, {int(doc_id): doc for doc_id, doc in docs.items()})
+            self.conn.execute(
+                "INSERT INTO meta VALUES ('imported', ?)", (str(self.import_path),)
+            )
+        logger.info(
+            "Imported %d documents from %s",
+            sum(len(docs) for docs in data.values()),
+            self.import_path,
+        )
+
+    def read(self, name):
+        if name not in SQLITE_COLUMNS:
+            rows = self.conn.execute(
+                "SELECT doc_id, data FROM docs WHERE name = ?", (name,)
+            )
+            return {doc_id: json.loads(data) for doc_id, data in rows}
+        docs = {
+            doc_id: json.loads(data)
+            for doc_id, data in self.conn.execute(f"SELECT doc_id, data FROM {name}")
+        }
+        for field, table in SQLITE_LISTS.get(name, {}).items():
+            for doc_id, username in self.conn.execute(
+                f"SELECT doc_id, username FROM {table} ORDER BY rowid"
+            ):
+                # Documents imported without the field only have its rows
+                docs[doc_id].setdefault(field, []).append(username)
+        return docs
+
+    def _row(self, name, doc_id, doc):
+        lists = SQLITE_LISTS.get(name, {})
+        data = {key: [] if key in lists else value for key, value in doc.items()}
+        columns = [doc.get(column) for column in SQLITE_COLUMNS[name]]
+        return (doc_id, *columns, json.dumps(data, ensure_ascii=False))
+
+    def _set_lists(self, name, doc_id, doc):
+        for field, table in SQLITE_LISTS.get(name, {}).items():
+            if field not in doc:
+                continue
+            self.conn.execute(f"DELETE FROM {table} WHERE doc_id = ?", (doc_id,))
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO {table} VALUES (?, ?)",
+                [(doc_id, username) for username in doc[field] or ()],
+            )
+
+    def _upsert(self, name, docs):
+        if name not in SQLITE_COLUMNS:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO docs VALUES (?, ?, ?)",
+                [
+                    (name, doc_id, json.dumps(doc, ensure_ascii=False))
+                    for doc_id, doc in docs.items()
+                ],
+            )
+            return
+        columns = ("doc_id", *SQLITE_COLUMNS[name], "data")
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns)
+        # Not INSERT OR REPLACE: deleting the row would cascade to the lists
+        self.conn.executemany(
+            f"INSERT INTO {name} VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT (doc_id) DO UPDATE SET {updates}",
+            [self._row(name, doc_id, doc) for doc_id, doc in docs.items()],
+        )
+
+    def _insert(self, name, docs):
+        self._upsert(name, docs)
+        for doc_id, doc in docs.items():
+            self._set_lists(name, doc_id, doc)
+
+    def insert(self, name, docs):
+        with transaction(self.conn):
+            self._insert(name, docs)
+
+    def _read_doc(self, name, doc_id):
+        if name in SQLITE_COLUMNS:
+            (data,) = self.conn.execute(
+                f"SELECT data FROM {name} WHERE doc_id = ?", (doc_id,)
+            ).fetchone()
+        else:
+            (data,) = self.conn.execute(
+                "SELECT data FROM docs WHERE name = ? AND doc_id = ?",
+                (name, doc_id),
+            ).fetchone()
+        return json.loads(data)
+
+    def update(self, name, doc_id, fields):
+        with transaction(self.conn):
+            doc = self._read_doc(name, doc_id)
+            doc.update(fields)
+            self._upsert(name, {doc_id: doc})
+            self._set_lists(name, doc_id, fields)
+
+    def add_item(self, name, doc_id, field, value):
+        table = SQLITE_LISTS.get(name, {}).get(field)
+        with transaction(self.conn):
+            if table is not None:
+                self.conn.execute(
+                    f"INSERT OR IGNORE INTO {table} VALUES (?, ?)", (doc_id, value)
+                )
+            else:
+                doc = self._read_doc(name, doc_id)
+                doc.setdefault(field, []).append(value)
+                self._upsert(name, {doc_id: doc})
+
+    def remove(self, name, doc_ids):
+        with transaction(self.conn):
+            if name not in SQLITE_COLUMNS:
+                self.conn.executemany(
+                    "DELETE FROM docs WHERE name = ? AND doc_id = ?",
+                    [(name, doc_id) for doc_id in doc_ids],
+                )
+                return
+            self.conn.executemany(
+                f"DELETE FROM {name} WHERE doc_id = ?",
+                [(doc_id,) for doc_id in doc_ids],
+            )
+
+    def flush(self):
+        pass
+
+    def compact(self):
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.execute("PRAGMA optimize")
+
+
+class IndexedTable:
+    """In-memory copy of a table with hash indexes.
+
+    Documents are read from the backend once by ``load``. Writes update the
+    in-memory copy before their first ``await``, so readers never see a
+    half-applied change, then are passed on to the backend on the store's
+    single writer thread, which keeps them in order. ``key`` is the primary
+    key field, or a tuple of fields for a composite key (``None`` for tables
+    addressed only by ``doc_id``); fields in ``indexes`` get a secondary
+    index, list values are indexed per item. For fields in ``versioned``
+    ``version(field, value)`` changes whenever a document with that value
+    is written, which lets callers cache results derived from them.
+    ``ordered=(group_field, sort_fields)`` keeps, per value of
+    ``group_field``, doc ids sorted by ``sort_fields`` for range scans.
+    With a ``sequence`` table, ``next_id`` hands out increasing keys that
+    are never reused, even after the newest document is removed.
+    """
+
+    def __init__(
+        self,
+        name,
+        backend,
+        executor,
+        key="id",
+        indexes=(),
+        versioned=(),
+        ordered=None,
+        sequence=None,
+    ):
+        self.name = name
+        self.backend = backend
+        self.executor = executor
+        self.key = key
+        self._docs = {}
+        self._keys = {}
+        self._indexes = {field: defaultdict(set) for field in indexes}
+        self._versioned = versioned
+        self._versions = Counter()
+        self._ordered = ordered
+        self._sorted = defaultdict(list)
+        self._next_doc_id = 1
+        self.sequence = sequence
+        self._last_id = 0
+
+    def load(self):
+        self._docs.clear()
+        self._keys.clear()
+        for index in self._indexes.values():
+            index.clear()
+        self._sorted.clear()
+        for doc_id, doc in self.backend.read(self.name).items():
+            self._add(doc_id, doc)
+        self._next_doc_id = max(self._docs, default=0) + 1
+        if self.sequence is not None:
+            # Databases from before sequences only have their documents
+            persisted = self.sequence.get(self.name)
+            self._last_id = max(
+                persisted["value"] if persisted else 0, max(self._keys, default=0)
+            )
+        logger.info("Loaded %d documents from %r", len(self._docs), self.name)
+
+    @staticmethod
+    def _values(value):
+        if isinstance(value, (list, tuple, set)):
+            return value
+        return (value,)
+
+    def _key_of(self, doc):
+        if isinstance(self.key, tuple):
+            if all(field in doc for field in self.key):
+                return tuple(doc[field] for field in self.key)
+            return None
+        return doc.get(self.key)
+
+    def _add(self, doc_id, doc):
+        self._docs[doc_id] = doc
+        if self.key is not None and (key := self._key_of(doc)) is not None:
+            self._keys[key] = doc_id
+        for field, index in self._indexes.items():
+            for value in self._values(doc.get(field)):
+                index[value].add(doc_id)
+        if self._ordered is not None:
+            bisect.insort(
+                self._sorted[doc.get(self._ordered[0])], self.sort_key(doc_id)
+            )
+        self._bump(doc)
+
+    def _discard(self, doc_id):
+        doc = self._docs.pop(doc_id)
+        key = self._key_of(doc) if self.key is not None else None
+        if key is not None and self._keys.get(key) == doc_id:
+            del self._keys[key]
+        for field, index in self._indexes.items():
+            for value in self._values(doc.get(field)):
+                ids = index.get(value)
+                if ids is not None:
+                    ids.discard(doc_id)
+                    if not ids:
+                        del index[value]
+        if self._ordered is not None:
+            group = self._sorted[doc.get(self._ordered[0])]
+            key = self.sort_key(doc_id, doc)
+            del group[bisect.bisect_left(group, key)]
+        self._bump(doc)
+        return doc
+
+    def sort_key(self, doc_id, doc=None):
+        """Position of a document in its ``ordered`` group."""
+        doc = doc if doc is not None else self._docs[doc_id]
+        return tuple(doc.get(field) or 0 for field in self._ordered[1]) + (doc_id,)
+
+    def ordered(self, value, start=(), stop=None, limit=None, reverse=False):
+        """Sorted doc ids of the ``value`` group with keys in [start, stop).
+
+        With ``limit`` only the first ``limit`` of them are returned, or the
+        last ones with ``reverse`` (still in ascending order).
+        """
+        group = self._sorted.get(value, [])
+        lo = bisect.bisect_left(group, tuple(start))
+        hi = len(group) if stop is None else bisect.bisect_left(group, tuple(stop))
+        if limit is not None:
+            if reverse:
+                lo = max(lo, hi - limit)
+            else:
+                hi = min(hi, lo + limit)
+        return [key[-1] for key in group[lo:hi]]
+
+    def _bump(self, doc):
+        for field in self._versioned:
+            for value in self._values(doc.get(field)):
+                self._versions[(field, value)] += 1
+
+    def version(self, field, value):
+        return self._versions[(field, value)]
+
+    def _document(self, doc_id):
+        return Document(deepcopy(self._docs[doc_id]), doc_id=doc_id)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def all(self):
+        return [self._document(doc_id) for doc_id in self._docs]
+
+    def has(self, key):
+        return key in self._keys
+
+    def get(self, key):
+        doc_id = self._keys.get(key)
+        if doc_id is None:
+            return None
+        return self._document(doc_id)
+
+    def get_doc(self, doc_id):
+        if doc_id not in self._docs:
+            return None
+        return self._document(doc_id)
+
+    def peek_doc(self, doc_id, *fields):
+        """Field values of a document without copying it, do not mutate."""
+        doc = self._docs[doc_id]
+        return tuple(doc.get(field) for field in fields)
+
+    def peek(self, key, *fields):
+        return self.peek_doc(self._keys[key], *fields)
+
+    def doc_ids(self, field, value):
+        return set(self._indexes[field].get(value, ()))
+
+    def count(self, field, value):
+        return len(self._indexes[field].get(value, ()))
+
+    def search(self, field, value):
+        return [self._document(doc_id) for doc_id in sorted(self.doc_ids(field, value))]
+
+    def contains(self, field, value, key):
+        return self._keys.get(key) in self._indexes[field].get(value, ())
+
+    async def next_id(self):
+        return (await self.next_ids(1))[0]
+
+    async def next_ids(self, count):
+        """Allocates the next ``count`` keys of the table.
+
+        The counter is written before the caller inserts the documents, and
+        writes reach the backend in order, so a persisted document always
+        has its id persisted in the sequence too.
+        """
+        first = self._last_id + 1
+        self._last_id += count
+        await self.sequence.upsert({"name": self.name, "value": self._last_id})
+        return list(range(first, first + count))
+
+    async def _persist(self, fn, *args):
+        # Includes the wait for the single writer thread
+        with metrics.timed("db_seconds", table=self.name, op=fn.__name__):
+            await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def insert(self, doc):
+        return (await self.insert_multiple([doc]))[0]
+
+    async def insert_multiple(self, docs):
+        new_docs = {}
+        for doc in docs:
+            new_docs[self._next_doc_id] = deepcopy(dict(doc))
+            self._next_doc_id += 1
+        for doc_id, doc in new_docs.items():
+            self._add(doc_id, doc)
+        await self._persist(self.backend.insert, self.name, deepcopy(new_docs))
+        return list(new_docs)
+
+    async def update(self, key, fields):
+        doc_id = self._keys[key]
+        return await self.update_doc_id(doc_id, fields)
+
+    def _apply(self, doc_id, fields):
+        doc = self._discard(doc_id)
+        doc.update(fields)
+        self._add(doc_id, doc)
+
+    async def update_doc_id(self, doc_id, fields):
+        fields = deepcopy(dict(fields))
+        self._apply(doc_id, fields)
+        result = self._document(doc_id)
+        await self._persist(self.backend.update, self.name, doc_id, fields)
+        return result
+
+    async def add_item(self, key, field, value):
+        """Appends ``value`` to the indexed list ``field`` of a document.
+
+        Unlike ``update`` only the index entry of ``value`` changes and the
+        backend stores the single item. Returns False if it was present.
+        """
+        doc_id = self._keys[key]
+        index = self._indexes[field]
+        if doc_id in index.get(value, ()):
+            return False
+        self._docs[doc_id].setdefault(field, []).append(value)
+        index[value].add(doc_id)
+        self._bump(self._docs[doc_id])
+        await self._persist(self.backend.add_item, self.name, doc_id, field, value)
+        return True
+
+    async def upsert(self, doc):
+        key = self._key_of(doc)
+        if key in self._keys:
+            return await self.update(key, doc)
+        await self.insert(doc)
+        return self.get(key)
+
+    async def remove(self, key):
+        doc_id = self._keys.get(key)
+        if doc_id is not None:
+            await self.remove_doc_ids([doc_id])
+
+    async def remove_many(self, keys):
+        await self.remove_doc_ids(
+            [self._keys[key] for key in keys if key in self._keys]
+        )
+
+    async def remove_doc_ids(self, doc_ids):
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id in self._docs]
+        if not doc_ids:
+            return
+        for doc_id in doc_ids:
+            self._discard(doc_id)
+        await self._persist(self.backend.remove, self.name, doc_ids)
+
+
+class Store:
+    def __init__(self, backend):
+        self.backend = backend
+        # One writer thread: backends are not thread-safe and writes must
+        # reach disk in the order they were applied in memory
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        # Last allocated id per table, see IndexedTable.next_id
+        self.sequences = IndexedTable("sequences", backend, self.executor, key="name")
+        self.events = IndexedTable(
+            "events",
+            backend,
+            self.executor,
+            indexes=("channel_id",),
+            versioned=("channel_id",),
+            ordered=("channel_id", ("day", "minutes")),
+            sequence=self.sequences,
+        )
+        self.channels = IndexedTable(
+            "channels",
+            backend,
+            self.executor,
+            indexes=("registered_users", "admins", "token", "admin_token"),
+            sequence=self.sequences,
+        )
+        self.notification = IndexedTable(
+            "notification",
+            backend,
+            self.executor,
+            key=None,
+            indexes=("event_id",),
+        )
+        self.settings = IndexedTable("settings", backend, self.executor, key="name")
+        self.registrations = IndexedTable(
+            "registrations",
+            backend,
+            self.executor,
+            key=("event_id", "username"),
+            indexes=("event_id", "username"),
+        )
+
+    def tables(self):
+        # Sequences first, the tables using them read them in ``load``
+        return [
+            self.sequences,
+            self.events,
+            self.channels,
+            self.notification,
+            self.settings,
+            self.registrations,
+        ]
+
+    def recover(self):
+        self.backend.recover()
+
+    def load(self):
+        started = time.perf_counter()
+        for table in self.tables():
+            table.load()
+        self._fix_taken()
+        elapsed = time.perf_counter() - started
+        metrics.observe("db_load_seconds", elapsed)
+        log = logger.warning if elapsed > DB_LOAD_WARN_SECONDS else logger.info
+        log("Loaded the store in %.2f s", elapsed)
+
+    def _fix_taken(self):
+        """Recounts ``taken`` of events from their registrations.
+
+        The counter and the registration are separate writes, a crash
+        between the two leaves it off by one. Runs before any other write.
+        """
+        fixed = 0
+        for doc_id in list(self.events._docs):
+            event_id, taken = self.events.peek_doc(doc_id, "id", "taken")
+            count = self.registrations.count("event_id", event_id)
+            if (taken or 0) != count:
+                self.events._apply(doc_id, {"taken": count})
+                self.backend.update("events", doc_id, {"taken": count})
+                fixed += 1
+        if fixed:
+            logger.warning("Recounted registrations of %d events", fixed)
+
+    async def flush(self):
+        with metrics.timed("db_seconds", table="*", op="flush"):
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.backend.flush
+            )
+
+    async def compact(self):
+        with metrics.timed("db_seconds", table="*", op="compact"):
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.backend.compact
+            )
+
+
+def open_store(path, backend="tinydb"):
+    """Opens the store for TinyDB file ``path`` with the named backend.
+
+    "tinydb" writes through to ``path``, "journal" journals writes next
+    to it and "sqlite" keeps them in ``path`` with a .sqlite3 suffix,
+    importing ``path`` on first start.
+    """
+    if backend == "journal":
+        return Store(JournalBackend(path))
+    if backend == "sqlite":
+        return Store(SQLiteBackend(Path(path).with_suffix(".sqlite3"), path))
+    if backend == "tinydb":
+        return Store(TinyDBBackend(path))
+    raise ValueError(f"Unknown storage backend {backend!r}")
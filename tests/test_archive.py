@@ -0,0 +1,49 @@
+from datetime import date
+import archive
+import dates
+import pytest
+import storage
+
+
+async def add_event(store, id, day, users):
+    await store.events.insert(
+        {"id": id, "name": f"e{id}", "channel_id": 1, **dates.date_fields(day)}
+    )
+    for user in users:
+        await store.registrations.insert({"event_id": id, "username": user})
+        await store.notification.insert({"event_id": id, "chat_id": 1, "date": day})
+
+
+@pytest.mark.asyncio
+async def test_past_events_move_to_monthly_files(tmp_path):
+    store = storage.open_store(tmp_path / "db.json")
+    store.load()
+    await add_event(store, 1, "2024-08-20", ["ann", "bob"])
+    await add_event(store, 2, "2024-09-02", ["bob"])
+    await add_event(store, 3, "2024-10-01", ["ann"])
+    directory = tmp_path / "archive"
+
+    event_ids = archive.select(store, 1, date(2024, 9, 30))
+    assert event_ids == [1, 2]
+    assert await archive.move(store, event_ids, directory) == 2
+
+    assert [event["id"] for event in store.events.all()] == [3]
+    assert len(store.registrations) == 1
+    assert len(store.notification) == 1
+    assert sorted(path.name for path in directory.iterdir()) == [
+        "events-2024-08.jsonl.gz",
+        "events-2024-09.jsonl.gz",
+    ]
+    assert [e["id"] for e in archive.attendance("bob", directory=directory)] == [1, 2]
+    september = archive.records(date(2024, 9, 1), directory=directory)
+    assert [record["event"]["id"] for record in september] == [2]
+    assert archive.channel_history(1, directory=directory)[0][1] == ["ann", "bob"]
+
+
+def test_repeated_records_are_read_once(tmp_path):
+    record = {"event": {"id": 1, "date": "2024-08-20", "channel_id": 1}}
+    archive.write([{**record, "registrations": ["ann"]}], tmp_path)
+    archive.write([{**record, "registrations": ["bob"]}], tmp_path)
+    assert [r["registrations"] for r in archive.records(directory=tmp_path)] == [
+        ["bob"]
+    ]
@@ -0,0 +1,36 @@
+import callbacks
+
+
+def test_round_trip():
+    data = callbacks.encode("event-remove-user", 12345, "user_name")
+    assert data.startswith(callbacks.VERSION)
+    assert callbacks.decode(data) == (
+        callbacks.CODES["event-remove-user"],
+        [12345, "user_name"],
+    )
+    assert callbacks.decode(callbacks.encode("settings")) == (
+        callbacks.CODES["settings"],
+        [],
+    )
+
+
+def test_longest_username_fits():
+    data = callbacks.encode("event-remove-user", 2**40, "u" * 32)
+    assert len(data.encode()) <= callbacks.MAX_LENGTH
+
+
+def test_legacy_data_is_decoded():
+    assert callbacks.decode("register 7") == (callbacks.CODES["register"], [7])
+    assert callbacks.decode("change-event 7 remove-user bob") == (
+        callbacks.CODES["event-remove-user"],
+        [7, "bob"],
+    )
+    assert callbacks.decode("change-event 7") == (
+        callbacks.CODES["change-event"],
+        [7],
+    )
+
+
+def test_unknown_data_resolves_to_none():
+    assert callbacks.resolve("bogus 1")[1] is None
+    assert callbacks.resolve("1!!")[:2] == (None, None)
@@ -0,0 +1,15 @@
+import pytest
+import dates
+
+
+def test_fields_are_normalized():
+    assert dates.date_fields("30.09.2024") == {"date": "2024-09-30", "day": 739159}
+    assert dates.time_fields("9.05") == {"time": "09:05", "minutes": 545}
+    assert dates.label({"day": 739159}) == "Mon 30.Sep"
+
+
+def test_invalid_values_are_rejected():
+    with pytest.raises(ValueError):
+        dates.date_fields("2024-13-01")
+    with pytest.raises(ValueError):
+        dates.time_fields("noon")
@@ -0,0 +1,53 @@
+from telegram.error import RetryAfter
+import time
+import pytest
+import dispatcher
+
+
+class FakeBot:
+    def __init__(self, fail_once=()):
+        self.sent = []
+        self.fail_once = set(fail_once)
+
+    async def send_message(self, chat_id, text):
+        if chat_id in self.fail_once:
+            self.fail_once.discard(chat_id)
+            raise RetryAfter(0)
+        self.sent.append((time.monotonic(), chat_id, text))
+
+
+def send(chat_id, count=1):
+    async def job(sender):
+        for i in range(count):
+            await sender.call("send_message", chat_id, text=f"{chat_id}-{i}")
+        return chat_id
+
+    return job
+
+
+@pytest.mark.asyncio
+async def test_global_rate_is_respected():
+    bot = FakeBot()
+    sender = dispatcher.Dispatcher(bot, global_rate=100, global_burst=1)
+    started = time.monotonic()
+    assert await sender.run([send(chat_id) for chat_id in range(21)]) == list(range(21))
+    assert time.monotonic() - started >= 0.19
+    assert len(bot.sent) == 21
+
+
+@pytest.mark.asyncio
+async def test_chat_rate_keeps_order_and_spacing():
+    bot = FakeBot()
+    sender = dispatcher.Dispatcher(bot, chat_rate=20, chat_burst=1)
+    await sender.run([send(1, count=3)])
+    times = [sent_at for sent_at, _, _ in bot.sent]
+    assert [text for _, _, text in bot.sent] == ["1-0", "1-1", "1-2"]
+    assert times[2] - times[0] >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_retry_after_is_retried():
+    bot = FakeBot(fail_once={7})
+    sender = dispatcher.Dispatcher(bot)
+    assert await sender.run([send(7)]) == [7]
+    assert [chat_id for _, chat_id, _ in bot.sent] == [7]
@@ -0,0 +1,108 @@
+from unittest.mock import AsyncMock, Mock
+import pytest
+import media
+import sched_bot
+import storage
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """sched_bot wired to a fresh store in ``tmp_path``."""
+    store = storage.open_store(tmp_path / "db.json")
+    store.load()
+    monkeypatch.setattr(sched_bot, "store", store)
+    for name in ("events", "channels", "notification", "settings", "registrations"):
+        monkeypatch.setattr(sched_bot, name, getattr(store, name))
+    media_store = media.MediaStore(tmp_path / "media.jsonl")
+    monkeypatch.setattr(sched_bot, "media_registry", media.MediaRegistry(media_store))
+    monkeypatch.setattr(sched_bot, "channels_obj", {})
+    monkeypatch.setattr(sched_bot, "wait_for_message", {})
+    return sched_bot
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "action", ["change-event", "event-name", "event-remove", "unregister"]
+)
+async def test_buttons_of_archived_events(bot, action):
+    query = Mock()
+    query.from_user.username = "ann"
+    _, handler, _ = bot.callbacks.resolve(bot.callbacks.encode(action, 1))
+    assert await handler(query, Mock(), 1) == (bot.EVENT_GONE, None, None)
+
+
+def message(username, text=None, args=()):
+    update = Mock()
+    update.effective_user.username = username
+    update.message.chat_id = 7
+    update.effective_chat.id = 7
+    update.message.text = text
+    update.message.reply_text = AsyncMock()
+    context = Mock()
+    context.args = list(args)
+    context.bot.send_message = AsyncMock()
+    return update, context
+
+
+async def add_channel(bot, name):
+    bot.wait_for_message[7] = {"type": "add-channel"}
+    await bot.msg_process(*message("boss", name))
+    (doc_id,) = bot.channels.doc_ids("admins", "boss")
+    return bot.channels.get_doc(doc_id)
+
+
+@pytest.mark.asyncio
+async def test_start_routes_tokens(bot):
+    channel = await add_channel(bot, "Chess")
+    ch, role = bot.start_route(channel["token"])
+    assert (ch.id, role) == (channel["id"], "user")
+    ch, role = bot.start_route(channel["admin_token"])
+    assert (ch.id, role) == (channel["id"], "admin")
+    assert bot.start_route("unknown") == (None, None)
+
+    await bot.start_command(*message("ann", args=[channel["token"]]))
+    await bot.start_command(*message("bob", args=[channel["admin_token"]]))
+    assert bot.channels.contains("registered_users", "ann", channel["id"])
+    assert bot.channels.contains("admins", "bob", channel["id"])
+    assert not bot.channels.contains("admins", "ann", channel["id"])
+
+
+@pytest.mark.asyncio
+async def test_unknown_start_token_shows_start(bot, monkeypatch):
+    await add_channel(bot, "Chess")
+    start = AsyncMock()
+    monkeypatch.setattr(bot, "start", start)
+    update, context = message("ann", args=["unknown"])
+    await bot.start_command(update, context)
+    start.assert_awaited_once_with(update, context)
+    assert not bot.channels.doc_ids("registered_users", "ann")
+
+
+@pytest.mark.asyncio
+async def test_series_ids_are_not_reused(bot):
+    channel = await add_channel(bot, "Chess")
+    await bot.add_series(channel["id"], "Йога@пн@18:00@10")
+    await bot.add_series(channel["id"], "Бег@вт@08:00@0")
+    await bot.on_del_series(Mock(), Mock(), channel["id"], 2)
+    await bot.add_series(channel["id"], "Плавание@ср@09:00@5")
+    templates = bot.channels.get(channel["id"])["series"]
+    assert [(t["name"], t["id"]) for t in templates] == [("Йога", 1), ("Плавание", 3)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("prompt", ["event-name", "event-capacity", "event-message"])
+async def test_replies_to_prompts_of_archived_events(bot, prompt):
+    bot.wait_for_message[7] = {"type": prompt, "event_id": 1}
+    update, context = message("boss", "10")
+    await bot.msg_process(update, context)
+    context.bot.send_message.assert_awaited_once_with(chat_id=7, text=bot.EVENT_GONE)
+
+
+@pytest.mark.asyncio
+async def test_photo_for_archived_event(bot):
+    bot.wait_for_message[7] = {"type": "event-message", "event_id": 1}
+    update, context = message("boss")
+    update.message.photo = [Mock(file_id="f")]
+    update.message.caption = None
+    await bot.photo_process(update, context)
+    context.bot.send_message.assert_awaited_once_with(chat_id=7, text=bot.EVENT_GONE)
@@ -0,0 +1,50 @@
+import importer
+import pytest
+
+
+def test_text_lines_are_parsed_with_errors():
+    events, errors = importer.parse_text(
+        "Йога@2024-10-01@18:00@10\n\nБег@01.10.2024@7.30@0\nПлохо@2024-10-01\n"
+        "Танцы@2024-13-01@18:00@5"
+    )
+    assert [event["name"] for event in events] == ["Йога", "Бег"]
+    assert events[1]["date"] == "2024-10-01"
+    assert events[1]["time"] == "07:30"
+    assert [line for line, _ in errors] == [4, 5]
+
+
+def test_csv_with_header():
+    events, errors = importer.parse_csv(
+        "name;date;time;capacity\nЙога;2024-10-01;18:00;10\nБег;2024-10-02;07:00;\n"
+    )
+    assert errors == []
+    assert [(e["name"], e["capacity"]) for e in events] == [("Йога", 10), ("Бег", 0)]
+
+
+def test_ics_events():
+    raw = (
+        "BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nSUMMARY:Йога для\r\n  начинающих\r\n"
+        "DTSTART;TZID=Europe/Moscow:20241001T180000\r\nX-CAPACITY:12\r\n"
+        "END:VEVENT\r\nBEGIN:VEVENT\r\nSUMMARY:Весь день\r\n"
+        "DTSTART;VALUE=DATE:20241002\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"
+    ).encode()
+    events, errors = importer.parse_file("schedule.ics", raw)
+    assert events == [
+        {
+            "name": "Йога для начинающих",
+            "date": "2024-10-01",
+            "day": events[0]["day"],
+            "time": "18:00",
+            "minutes": 18 * 60,
+            "capacity": 12,
+        }
+    ]
+    assert len(errors) == 1
+
+
+def test_capacity_is_validated():
+    assert importer.parse_capacity(" 12 ") == 12
+    assert importer.parse_capacity("") == 0
+    for text in ("-1", "ten", "1.5"):
+        with pytest.raises(ValueError, match="Неверное количество мест"):
+            importer.parse_capacity(text)
@@ -0,0 +1,38 @@
+import asyncio
+import pytest
+import locks
+
+
+@pytest.mark.asyncio
+async def test_independent_keys_run_concurrently():
+    manager = locks.LockManager()
+    order = []
+
+    async def worker(key, name):
+        async with manager.hold(key):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} end")
+
+    await asyncio.gather(
+        worker(locks.event(1), "a"), worker(locks.event(2), "b")
+    )
+    assert order[:2] == ["a start", "b start"]
+
+
+@pytest.mark.asyncio
+async def test_overlapping_keys_do_not_deadlock():
+    manager = locks.LockManager()
+
+    async def worker(*keys):
+        async with manager.hold(*keys):
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(
+        asyncio.gather(
+            worker(locks.event(1), locks.notification(1)),
+            worker(locks.notification(1), locks.event(1)),
+        ),
+        timeout=1,
+    )
+    assert not manager._locks
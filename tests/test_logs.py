@@ -0,0 +1,36 @@
+import json
+import logging
+import logs
+
+
+def test_json_lines_with_extra_fields(tmp_path):
+    path = tmp_path / "bot.log"
+    logs.setup(level="INFO", levels="noisy=ERROR", format="json", path=str(path))
+    try:
+        logging.getLogger("bot").info("Event %s", 7, extra={"channel_id": 3})
+        logging.getLogger("noisy").warning("dropped")
+    finally:
+        logs.shutdown()
+        logging.getLogger().handlers.clear()
+    (line,) = path.read_text().splitlines()
+    entry = json.loads(line)
+    assert entry["msg"] == "Event 7"
+    assert entry["logger"] == "bot"
+    assert entry["channel_id"] == 3
+
+
+def test_hot_records_are_sampled():
+    sampler = logs.HotSampler(0)
+    hot = logging.makeLogRecord({"levelno": logging.INFO, "hot": True})
+    warning = logging.makeLogRecord({"levelno": logging.WARNING, "hot": True})
+    cold = logging.makeLogRecord({"levelno": logging.INFO})
+    assert not sampler.filter(hot)
+    assert sampler.filter(warning)
+    assert sampler.filter(cold)
+
+
+def test_parse_levels():
+    assert logs.parse_levels("storage=warning, telegram=INFO,") == {
+        "storage": "WARNING",
+        "telegram": "INFO",
+    }
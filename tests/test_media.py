@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+import pytest
+import media
+
+
+def test_legacy_records_are_normalized():
+    photo = SimpleNamespace(file_id="photo-id")
+    assert media.as_record({"photo": photo, "msg": "hi"}) == {
+        "file_id": "photo-id",
+        "caption": "hi",
+    }
+    assert media.as_record({"photo": None, "msg": "hi"})["file_id"] is None
+    assert media.as_record(photo) == {"file_id": "photo-id", "caption": None}
+
+
+def test_store_survives_reload_and_compaction(tmp_path):
+    store = media.MediaStore(tmp_path / "media.jsonl")
+    store.write("a", "welcome", "file-a", "first")
+    store.write("b", "event", None, "second")
+    store.write("orphan", "event", None, "third")
+    store.delete("b")
+
+    reloaded = media.MediaStore(tmp_path / "media.jsonl")
+    reloaded.load()
+    assert reloaded.read("a") == {"file_id": "file-a", "caption": "first"}
+    assert reloaded.read("b") is None
+
+    reloaded.compact({"a"})
+    assert reloaded.read("a")["caption"] == "first"
+    assert "orphan" not in reloaded
+    assert len((tmp_path / "media.jsonl").read_text().splitlines()) == 1
+
+
+@pytest.mark.asyncio
+async def test_cached_records_skip_disk(tmp_path):
+    registry = media.MediaRegistry(media.MediaStore(tmp_path / "media.jsonl"))
+    uuid = await registry.save("welcome", "photo-id", "caption")
+    (tmp_path / "media.jsonl").unlink()
+    assert (await registry.get(uuid))["file_id"] == "photo-id"
+
+
+def test_sqlite_store_imports_json_lines(tmp_path):
+    legacy = media.MediaStore(tmp_path / "media.jsonl")
+    legacy.write("a", "welcome", "file-a", "first")
+    legacy.write("orphan", "event", None, "third")
+
+    store = media.SQLiteMediaStore(tmp_path / "db.sqlite3", tmp_path / "media.jsonl")
+    store.load()
+    assert store.read("a") == {"file_id": "file-a", "caption": "first"}
+    store.write("b", "event", None, "second")
+    store.delete("a")
+    store.compact({"b"})
+
+    reloaded = media.SQLiteMediaStore(tmp_path / "db.sqlite3", tmp_path / "none")
+    reloaded.load()
+    assert len(reloaded) == 1
+    assert reloaded.read("b")["caption"] == "second"
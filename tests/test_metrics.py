@@ -0,0 +1,49 @@
+import asyncio
+import pytest
+import metrics
+
+
+def test_histogram_buckets_and_render():
+    registry = metrics.Registry()
+    for seconds in (0.0005, 0.003, 0.003, 7):
+        registry.observe("handler_seconds", seconds, handler="start")
+    registry.inc("notifications_sent_total", 3)
+    text = registry.render()
+    assert "notifications_sent_total 3\n" in text
+    assert 'handler_seconds_bucket{handler="start",le="0.001"} 1' in text
+    assert 'handler_seconds_bucket{handler="start",le="0.005"} 3' in text
+    assert 'handler_seconds_bucket{handler="start",le="+Inf"} 4' in text
+    assert 'handler_seconds_count{handler="start"} 4' in text
+    hist = registry.histograms["handler_seconds", (("handler", "start"),)]
+    assert hist.quantile(0.5) == 0.005
+    assert hist.quantile(0.99) == float("inf")
+
+
+@pytest.mark.asyncio
+async def test_instrument_counts_errors():
+    registry = metrics.Registry()
+
+    @registry.instrument("handler_seconds", handler="boom")
+    async def boom():
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        await boom()
+    assert registry.counters["handler_seconds_errors_total", (("handler", "boom"),)]
+    assert "errors=1" in registry.summary()
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    metrics.registry.inc("test_endpoint_total")
+    server = await metrics.start_server("127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = (await reader.read()).decode()
+        writer.close()
+    finally:
+        server.close()
+    assert response.startswith("HTTP/1.1 200 OK")
+    assert "test_endpoint_total 1" in response
@@ -0,0 +1,97 @@
+from datetime import date, datetime, time, timedelta
+from unittest.mock import Mock
+import pytest
+import scheduler
+import storage
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when):
+        job = Mock()
+        job.callback = callback
+        job.when = when
+        self.jobs.append(job)
+        return job
+
+
+@pytest.mark.asyncio
+async def test_single_job_follows_earliest_notification(tmp_path, monkeypatch):
+    monkeypatch.setattr(scheduler, "NOTIFY_HOUR", 0)
+    store = storage.open_store(tmp_path / "db.json")
+    store.load()
+    table = store.notification
+    sent = []
+
+    async def callback(context, docs):
+        sent.extend(doc["chat_id"] for doc in docs)
+
+    job_queue = FakeJobQueue()
+    notifications = scheduler.NotificationScheduler(table, callback)
+    notifications.start(job_queue)
+    assert job_queue.jobs == []
+
+    today = date.today()
+    later = await table.insert(
+        {"event_id": 1, "chat_id": 1, "date": (today + timedelta(days=2)).isoformat()}
+    )
+    notifications.add([later])
+    due = await table.insert({"event_id": 2, "chat_id": 2, "date": today.isoformat()})
+    notifications.add([due])
+    assert len(job_queue.jobs) == 2
+    assert job_queue.jobs[0].schedule_removal.called
+    assert job_queue.jobs[1].when == 0
+
+    await job_queue.jobs[1].callback(Mock())
+    assert sent == [2]
+    # Re-armed for the remaining notification only
+    assert len(job_queue.jobs) == 3
+    assert job_queue.jobs[2].when > 0
+
+
+@pytest.mark.asyncio
+async def test_undelivered_notifications_are_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(scheduler, "NOTIFY_HOUR", 0)
+    monkeypatch.setattr(scheduler, "NOTIFY_RETRY_SECONDS", 0)
+    store = storage.open_store(tmp_path / "db.json")
+    store.load()
+    table = store.notification
+    attempts = []
+
+    async def callback(context, docs):
+        attempts.append([doc.doc_id for doc in docs])
+        # Fails twice, then the notification is delivered
+        return [doc.doc_id for doc in docs] if len(attempts) < 3 else []
+
+    job_queue = FakeJobQueue()
+    notifications = scheduler.NotificationScheduler(table, callback)
+    notifications.start(job_queue)
+    today = date.today().isoformat()
+    doc_id = await table.insert({"event_id": 1, "chat_id": 1, "date": today})
+    notifications.add([doc_id])
+
+    for _ in range(3):
+        await job_queue.jobs[-1].callback(Mock())
+    assert attempts == [[doc_id]] * 3
+    jobs = len(job_queue.jobs)
+    await job_queue.jobs[-1].callback(Mock())
+    assert len(attempts) == 3 and len(job_queue.jobs) == jobs
+
+
+@pytest.mark.asyncio
+async def test_retry_delay_grows(tmp_path, monkeypatch):
+    monkeypatch.setattr(scheduler, "NOTIFY_RETRY_SECONDS", 60)
+    store = storage.open_store(tmp_path / "db.json")
+    store.load()
+    notifications = scheduler.NotificationScheduler(store.notification, None)
+    now = datetime(2024, 9, 30, 23, 57)
+    notifications._retry([1], now)
+    notifications._retry([1], now)
+    notifications._retry([1], now)
+    assert sorted(due for due, _ in notifications._heap) == [
+        now + timedelta(seconds=60),
+        now + timedelta(seconds=120),
+        datetime.combine(now.date(), time.max),
+    ]
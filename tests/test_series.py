@@ -0,0 +1,35 @@
+from datetime import date
+import pytest
+import series
+import storage
+
+MONDAY = date(2024, 9, 30)
+
+
+def test_parse_weekdays():
+    template = series.parse("Йога@пн, ср,7@18:00@10", today=MONDAY)
+    assert template["weekdays"] == [0, 2, 6]
+    assert template["minutes"] == 18 * 60
+    with pytest.raises(ValueError):
+        series.parse("Йога@xx@18:00@10")
+
+
+@pytest.mark.asyncio
+async def test_materialize_within_horizon_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(series, "SERIES_HORIZON_DAYS", 13)
+    store = storage.open_store(tmp_path / "db.json")
+    store.load()
+    template = {"id": 1, **series.parse("Йога@пн,чт@18:00@10", today=MONDAY)}
+    await store.channels.insert({"id": 1, "series": [template]})
+
+    assert await series.materialize(store.channels, store.events, 1, MONDAY) == 4
+    days = [event["date"] for event in store.events.all()]
+    assert days == ["2024-09-30", "2024-10-03", "2024-10-07", "2024-10-10"]
+    assert {event["series_id"] for event in store.events.all()} == {1}
+
+    # A deleted instance is not created again, the next day adds only new ones
+    await store.events.remove(store.events.all()[0]["id"])
+    assert await series.materialize(store.channels, store.events, 1, MONDAY) == 0
+    sunday = date(2024, 10, 6)
+    assert await series.materialize(store.channels, store.events, 1, sunday) == 2
+    assert len(store.events) == 5
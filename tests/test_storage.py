@@ -0,0 +1,349 @@
+import pytest
+import storage
+
+
+def make_store(tmp_path, backend="tinydb"):
+    store = storage.open_store(tmp_path / "db.json", backend=backend)
+    store.recover()
+    store.load()
+    return store
+
+
+@pytest.mark.asyncio
+async def test_indexes_follow_updates(tmp_path):
+    store = make_store(tmp_path)
+    await store.channels.insert({"id": 1, "admins": ["a"], "registered_users": []})
+    channel = store.channels.get(1)
+    channel["registered_users"].append("user")
+    assert not store.channels.contains("registered_users", "user", 1)
+
+    await store.channels.update(1, channel)
+    assert store.channels.contains("registered_users", "user", 1)
+    assert [c["id"] for c in store.channels.search("admins", "a")] == [1]
+
+    await store.channels.remove(1)
+    assert store.channels.get(1) is None
+    assert store.channels.search("registered_users", "user") == []
+
+
+@pytest.mark.asyncio
+async def test_load_reads_persisted_documents(tmp_path):
+    store = make_store(tmp_path)
+    await store.notification.insert(
+        {"event_id": 1, "chat_id": 10, "date": "2024-09-29"}
+    )
+    store.load()
+    assert store.notification.search("event_id", 1)[0]["date"] == "2024-09-29"
+
+
+@pytest.mark.asyncio
+async def test_journal_is_replayed_and_compacted(tmp_path):
+    store = make_store(tmp_path, backend="journal")
+    await store.channels.insert({"id": 1, "name": "first"})
+    await store.channels.insert({"id": 2, "name": "second"})
+    await store.channels.update(1, {"name": "renamed"})
+    await store.channels.remove(2)
+    await store.flush()
+    assert (tmp_path / "db.json.journal").exists()
+
+    # A restart before compaction sees the journal on top of the snapshot
+    restarted = make_store(tmp_path, backend="journal")
+    assert [c["name"] for c in restarted.channels.all()] == ["renamed"]
+    assert not (tmp_path / "db.json.journal").exists()
+
+
+@pytest.mark.asyncio
+async def test_version_changes_with_channel_events(tmp_path):
+    store = make_store(tmp_path)
+    before = store.events.version("channel_id", 1)
+    await store.events.insert(
+        {"id": 1, "channel_id": 1, "date": "2024-09-30", "registered_users": []}
+    )
+    inserted = store.events.version("channel_id", 1)
+    assert inserted != before
+
+    await store.events.insert(
+        {"id": 2, "channel_id": 2, "date": "2024-09-30", "registered_users": []}
+    )
+    assert store.events.version("channel_id", 1) == inserted
+
+    await store.events.update(1, {"registered_users": ["user"]})
+    assert store.events.version("channel_id", 1) != inserted
+
+
+@pytest.mark.asyncio
+async def test_ordered_index_scans_upcoming_events(tmp_path):
+    store = make_store(tmp_path)
+    for event_id, day, minutes in [(1, 20, 600), (2, 10, 0), (3, 20, 60), (4, 30, 0)]:
+        await store.events.insert(
+            {"id": event_id, "channel_id": 1, "day": day, "minutes": minutes}
+        )
+    ids = lambda doc_ids: [store.events.get_doc(i)["id"] for i in doc_ids]
+    assert ids(store.events.ordered(1)) == [2, 3, 1, 4]
+    assert ids(store.events.ordered(1, (20,))) == [3, 1, 4]
+
+    await store.events.update(4, {"day": 15})
+    await store.events.remove(3)
+    assert ids(store.events.ordered(1, (11,), (21,))) == [4, 1]
+
+
+@pytest.mark.asyncio
+async def test_ordered_index_pages(tmp_path):
+    store = make_store(tmp_path)
+    for event_id in range(1, 8):
+        await store.events.insert({"id": event_id, "channel_id": 1, "day": event_id})
+    ids = lambda doc_ids: [store.events.get_doc(i)["id"] for i in doc_ids]
+    assert ids(store.events.ordered(1, limit=3)) == [1, 2, 3]
+    key = store.events.sort_key(store.events.ordered(1, limit=3)[-1])
+    after = (*key[:-1], key[-1] + 1)
+    assert ids(store.events.ordered(1, after, limit=3)) == [4, 5, 6]
+    assert ids(store.events.ordered(1, (), (5,), limit=3, reverse=True)) == [2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_membership_index_for_channels(tmp_path):
+    store = make_store(tmp_path)
+    await store.channels.insert({"id": 1, "registered_users": ["a"], "admins": ["b"]})
+    await store.channels.insert({"id": 2, "registered_users": ["a", "b"], "admins": []})
+    assert len(store.channels.doc_ids("registered_users", "a")) == 2
+    assert store.channels.contains("admins", "b", 1)
+    assert not store.channels.contains("admins", "b", 2)
+    assert store.channels.peek(2, "registered_users") == (["a", "b"],)
+
+
+@pytest.mark.asyncio
+async def test_sqlite_backend_round_trip(tmp_path):
+    store = make_store(tmp_path, backend="sqlite")
+    await store.events.insert({"id": 1, "channel_id": 1, "day": 5, "taken": 1})
+    await store.events.update(1, {"name": "renamed"})
+    await store.channels.insert({"id": 1, "admins": ["a"], "registered_users": ["a"]})
+    await store.channels.update(1, {"registered_users": ["b", "c"]})
+    await store.registrations.insert({"event_id": 1, "username": "b"})
+    await store.settings.upsert({"name": "base_image", "value": "uuid"})
+    await store.notification.insert_multiple(
+        [{"event_id": 1, "chat_id": 10, "date": "2024-09-29"}] * 2
+    )
+    await store.notification.remove_doc_ids([1])
+
+    restarted = make_store(tmp_path, backend="sqlite")
+    assert restarted.events.get(1) == {
+        "id": 1,
+        "channel_id": 1,
+        "day": 5,
+        "name": "renamed",
+        "taken": 1,
+    }
+    assert restarted.channels.get(1)["registered_users"] == ["b", "c"]
+    assert restarted.registrations.has((1, "b"))
+    assert restarted.settings.get("base_image")["value"] == "uuid"
+    assert [n.doc_id for n in restarted.notification.all()] == [2]
+    conn = restarted.backend.conn
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert conn.execute("SELECT count(*) FROM subscribers").fetchone() == (2,)
+
+
+@pytest.mark.asyncio
+async def test_sqlite_imports_tinydb_file_once(tmp_path):
+    tinydb = make_store(tmp_path)
+    await tinydb.channels.insert(
+        {"id": 1, "name": "c", "registered_users": ["u"], "admins": ["a"]}
+    )
+    tinydb.backend.db.table("migrations").insert({"name": "users_as_names"})
+    tinydb.backend.db.close()
+
+    store = make_store(tmp_path, backend="sqlite")
+    assert store.channels.contains("admins", "a", 1)
+    await store.channels.remove(1)
+    store.recover()
+    store.load()
+    assert store.channels.get(1) is None
+    assert store.backend.read("migrations") == {1: {"name": "users_as_names"}}
+
+
+@pytest.mark.asyncio
+async def test_composite_key_lookups(tmp_path):
+    store = make_store(tmp_path)
+    await store.registrations.insert_multiple(
+        [{"event_id": 1, "username": "a"}, {"event_id": 1, "username": "b"}]
+    )
+    assert store.registrations.has((1, "a"))
+    assert store.registrations.count("event_id", 1) == 2
+    await store.registrations.remove((1, "a"))
+    assert not store.registrations.has((1, "a"))
+    assert store.registrations.get((1, "b"))["username"] == "b"
+
+
+def test_sqlite_schema_moves_event_user_lists(tmp_path):
+    path = tmp_path / "db.sqlite3"
+    conn = storage.sqlite3.connect(path)
+    for statement in filter(str.strip, storage.SQLITE_SCHEMA[0].split(";")):
+        conn.execute(statement)
+    conn.execute("PRAGMA user_version=1")
+    conn.execute("""INSERT INTO events VALUES (7, 1, 1, 0, 0, '{"id": 1}')""")
+    conn.executemany("INSERT INTO registrations VALUES (7, ?)", [("b",), ("a",)])
+    conn.commit()
+    conn.close()
+
+    backend = storage.SQLiteBackend(path)
+    assert backend.read("events") == {7: {"id": 1, "taken": 2}}
+    assert list(backend.read("registrations").values()) == [
+        {"event_id": 1, "username": "b"},
+        {"event_id": 1, "username": "a"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_snapshots_are_checksummed(tmp_path):
+    store = make_store(tmp_path)
+    await store.settings.insert({"key": "v"})
+    path = tmp_path / "db.json"
+    assert storage.checksum_path(path).exists()
+    assert not path.with_name("db.json.tmp").exists()
+    assert storage.validate_snapshot(path) == path.read_bytes()
+
+
+def test_corrupt_snapshot_is_detected(tmp_path):
+    path = tmp_path / "db.json"
+    storage.write_snapshot(path, {"settings": {"1": {"key": "v"}}})
+    path.write_bytes(path.read_bytes()[:-5])
+    with pytest.raises(storage.CorruptSnapshotError):
+        storage.open_store(path, backend="journal").recover()
+
+
+def test_altered_snapshot_is_rejected(tmp_path):
+    path = tmp_path / "db.json"
+    storage.write_snapshot(path, {"events": {"1": {"capacity": 10}}})
+    path.write_text(path.read_text().replace("10", "90"))
+    with pytest.raises(storage.CorruptSnapshotError):
+        storage.validate_snapshot(path)
+
+
+def test_snapshot_left_by_a_crash_is_accepted(tmp_path):
+    path = tmp_path / "db.json"
+    storage.write_snapshot(path, {"settings": {}})
+    old = path.read_bytes()
+    storage.write_snapshot(path, {"settings": {"1": {"key": "v"}}})
+    assert storage.validate_snapshot(path) == path.read_bytes()
+    # Crash after the sidecar was replaced but before the snapshot was
+    path.write_bytes(old)
+    assert storage.validate_snapshot(path) == old
+
+
+def test_snapshot_survives_repeated_crashes(tmp_path, monkeypatch):
+    path = tmp_path / "db.json"
+    storage.write_snapshot(path, {"settings": {}})
+    old = path.read_bytes()
+    replace_sidecar_only = storage.write_atomic
+
+    def crash(target, raw):
+        if target != storage.checksum_path(path):
+            raise OSError("crash")
+        replace_sidecar_only(target, raw)
+
+    monkeypatch.setattr(storage, "write_atomic", crash)
+    for value in ("a", "b"):
+        with pytest.raises(OSError):
+            storage.write_snapshot(path, {"settings": {"1": {"key": value}}})
+        assert storage.validate_snapshot(path) == old
+
+
+def test_snapshot_without_checksum_is_accepted_once(tmp_path):
+    path = tmp_path / "db.json"
+    path.write_text('{"settings": {}}')
+    storage.validate_snapshot(path)
+    assert storage.checksum_path(path).exists()
+    path.write_text('{"settings": {"1": {}}}')
+    with pytest.raises(storage.CorruptSnapshotError):
+        storage.validate_snapshot(path)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["tinydb", "journal", "sqlite"])
+async def test_ids_are_not_reused(tmp_path, backend):
+    store = make_store(tmp_path, backend)
+    await store.events.insert({"id": await store.events.next_id(), "name": "a"})
+    newest = await store.events.next_id()
+    await store.events.insert({"id": newest, "name": "b"})
+    await store.events.remove(newest)
+    await store.flush()
+
+    store = make_store(tmp_path, backend)
+    assert await store.events.next_id() == newest + 1
+
+
+@pytest.mark.asyncio
+async def test_sequence_starts_after_existing_ids(tmp_path):
+    store = make_store(tmp_path)
+    await store.channels.insert({"id": 7, "admins": [], "registered_users": []})
+    store = make_store(tmp_path)
+    assert await store.channels.next_id() == 8
+
+
+def test_journal_loads_migrated_snapshot(tmp_path):
+    import migration
+
+    path = tmp_path / "db.json"
+    done = ["users_as_names", "int_event_id", "pickle_media"]
+    storage.write_snapshot(
+        path,
+        {
+            "events": {
+                "1": {
+                    "id": 1,
+                    "date": "2024-09-30",
+                    "time": "12:00",
+                    "channel_id": 1,
+                    "registered_users": ["ann"],
+                }
+            },
+            "migrations": {str(i): {"name": name} for i, name in enumerate(done, 1)},
+        },
+    )
+    store = storage.open_store(path, backend="journal")
+    store.recover()
+    migration.apply(path)
+    store.load()
+
+    event = store.events.get(1)
+    assert event["taken"] == 1 and event["day"] and "registered_users" not in event
+    assert store.registrations.has((1, "ann"))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["tinydb", "journal", "sqlite"])
+async def test_taken_is_recounted_on_load(tmp_path, backend):
+    store = make_store(tmp_path, backend)
+    await store.events.insert({"id": 1, "channel_id": 1, "taken": 2})
+    await store.events.insert({"id": 2, "channel_id": 1})
+    # The counter of event 2 was lost in a crash after the registration
+    await store.registrations.insert({"event_id": 1, "username": "ann"})
+    await store.registrations.insert({"event_id": 2, "username": "bob"})
+    await store.flush()
+
+    store = make_store(tmp_path, backend)
+    assert store.events.peek(1, "taken") == (1,)
+    assert store.events.peek(2, "taken") == (1,)
+    store.backend.flush()
+    store = make_store(tmp_path, backend)
+    assert store.events.peek(2, "taken") == (1,)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["tinydb", "journal", "sqlite"])
+async def test_membership_items(tmp_path, backend):
+    store = make_store(tmp_path, backend)
+    await store.channels.insert({"id": 1, "registered_users": ["a"], "admins": []})
+    assert await store.channels.add_item(1, "registered_users", "b")
+    assert not await store.channels.add_item(1, "registered_users", "a")
+    assert await store.channels.add_item(1, "admins", "c")
+    # Channels created by add_channels.py have no registered_users
+    await store.channels.insert({"id": 2, "admins": ["a"]})
+    assert await store.channels.add_item(2, "registered_users", "d")
+    assert store.channels.contains("registered_users", "b", 1)
+    assert store.channels.doc_ids("registered_users", "a") == {1}
+    await store.flush()
+
+    store = make_store(tmp_path, backend)
+    assert store.channels.peek(1, "registered_users", "admins") == (["a", "b"], ["c"])
+    assert store.channels.contains("admins", "c", 1)
+    assert store.channels.peek(2, "registered_users") == (["d"],)
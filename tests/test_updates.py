@@ -0,0 +1,128 @@
+from telegram import Bot, Update, User
+from telegram.ext import Application, TypeHandler
+import asyncio
+import json
+import socket
+import urllib.request
+import pytest
+import updates
+
+
+class LocalBot(Bot):
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = User(1, "bot", True, username="local_bot")
+        return self._bot_user
+
+    async def set_webhook(self, *args, **kwargs):
+        return True
+
+    async def delete_webhook(self, *args, **kwargs):
+        return True
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def post(url, update_id, chat_id, text):
+    body = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "user"},
+            "text": text,
+        },
+    }
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        return response.status
+
+
+@pytest.mark.asyncio
+async def test_webhook_orders_chats_and_runs_them_concurrently():
+    application = (
+        Application.builder()
+        .bot(LocalBot("1:local"))
+        .concurrent_updates(updates.ChatOrderedUpdateProcessor(8))
+        .build()
+    )
+    seen = []
+    done = asyncio.Event()
+
+    async def record(update, context):
+        seen.append(("start", update.message.text))
+        await asyncio.sleep(0.05)
+        seen.append(("end", update.message.text))
+        if len(seen) == 6:
+            done.set()
+
+    application.add_handler(TypeHandler(Update, record))
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/telegram"
+    async with application:
+        await application.updater.start_webhook(
+            listen="127.0.0.1", port=port, url_path="telegram"
+        )
+        await application.start()
+        for update_id, (chat_id, text) in enumerate(
+            [(10, "a1"), (10, "a2"), (20, "b1")], 1
+        ):
+            assert await asyncio.to_thread(post, url, update_id, chat_id, text) == 200
+        await asyncio.wait_for(done.wait(), 5)
+        await application.updater.stop()
+        await application.stop()
+
+    # Chat 20 does not wait for chat 10, chat 10 stays in order
+    assert seen.index(("start", "b1")) < seen.index(("end", "a1"))
+    assert seen.index(("end", "a1")) < seen.index(("start", "a2"))
+
+
+def message_update(update_id, chat_id):
+    return Update.de_json(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "text": "x",
+            },
+        },
+        None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_busy_chat_does_not_hold_every_slot():
+    processor = updates.ChatOrderedUpdateProcessor(2)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    finished = {}
+
+    async def handle(name, seconds):
+        await asyncio.sleep(seconds)
+        finished[name] = loop.time() - start
+
+    tasks = [
+        asyncio.create_task(
+            processor.process_update(message_update(i, 10), handle(f"a{i}", 0.2))
+        )
+        for i in range(4)
+    ]
+    await asyncio.sleep(0)
+    tasks.append(
+        asyncio.create_task(
+            processor.process_update(message_update(5, 20), handle("b", 0.01))
+        )
+    )
+    await asyncio.gather(*tasks)
+    assert finished["b"] < 0.1
+    assert finished["a3"] >= 0.8
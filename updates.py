@@ -0,0 +1,51 @@
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import asyncio
+import locks
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Updates handled at the same time; 1 keeps the old sequential behaviour
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 1))
+
+
+def chat_id(update):
+    if isinstance(update, Update) and update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but one at a time per chat.
+
+    ``wait_for_message`` and the button flows assume a chat's updates are
+    handled in the order they arrive, so each update first takes its
+    chat's lock. Updates without a chat (inline queries) are not ordered.
+    The base class gets no limit: its slot would be taken before the chat
+    lock, and the queued updates of one busy chat would hold every slot.
+    The limit is a slot taken once the chat's turn has come.
+    """
+
+    def __init__(self, max_concurrent_updates=CONCURRENT_UPDATES):
+        super().__init__(sys.maxsize)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.chats = locks.LockManager()
+
+    async def do_process_update(self, update, coroutine):
+        key = chat_id(update)
+        if key is None:
+            async with self.slots:
+                await coroutine
+            return
+        async with self.chats.hold(locks.chat(key)):
+            async with self.slots:
+                await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass